@@ -0,0 +1,363 @@
+import os
+import re
+import json
+import unicodedata
+from extract_ocr import HEADER_KEYWORDS, is_table_header, is_grid_line
+
+# ----- Template Settings -----
+TEMPLATES_ENABLED = os.getenv("GMI_TEMPLATES", "1") != "0"
+# Share of date-led lines that must parse cleanly before the template result is trusted
+MIN_TEMPLATE_CONFIDENCE = float(os.getenv("GMI_TEMPLATE_MIN_CONFIDENCE", "0.8"))
+# Largest allowed gap (in euros) between opening + movements and the closing balance: under a cent
+BALANCE_TOLERANCE = 0.005
+
+# French decimals, with or without thousand separators ("1 234,56", "1.234,56", "1234,56")
+AMOUNT_RE = re.compile(r"(?<![\d,.])([+\-]?(?:\d{1,3}(?:[ . ]\d{3})+|\d+),\d{2})(?![\d,])")
+FULL_DATE_RE = re.compile(r"\b(\d{2})[/.](\d{2})[/.](\d{4}|\d{2})\b")
+PERIOD_RE = re.compile(r"\bDU\s+(\d{2}[/.]\d{2}[/.]\d{2,4})\s+(?:AU\s+)?(\d{2}[/.]\d{2}[/.]\d{2,4})")
+ACCOUNT_RE = re.compile(r"\b(?:COMPTE|N° DE COMPTE|NUMERO DE COMPTE)\D{0,12}(\d[\d ]{6,}\d)")
+AMOUNT_FIELDS = ("debit", "credit", "balance")
+CELL_SEPARATOR = " | "
+
+# Label words that mark a credit when the page has no readable DEBIT/CREDIT header
+DEFAULT_CREDIT_KEYWORDS = ("VIR RECU", "VIREMENT RECU", "VIR SEPA RECU", "VIR DE", "REMISE", "VERSEMENT", "AVOIR", "REMBOURSEMENT")
+
+def normalize_line(line):
+    """Upper case, accents stripped, so labels match whatever the OCR made of them."""
+    return unicodedata.normalize("NFKD", line).encode("ascii", "ignore").decode().upper()
+
+def parse_amount(value):
+    """French amount string ("1 610,00") to float."""
+    return float(re.sub(r"[ . ]", "", value).replace(",", "."))
+
+def table_lines(text):
+    """
+    For text in the "tsv" or "grid" layout, (lines, spans): every table row as one line with
+    its cells joined by CELL_SEPARATOR, and per line the (start, end, column name) of each
+    cell. None when the text is plain "spaces" layout.
+    """
+    raw_lines = [line for line in text.splitlines() if line.strip()]
+    if not raw_lines:
+        return None
+    first = raw_lines[0]
+    if not (is_grid_line(first) or is_table_header(first)):
+        return None
+
+    lines, spans = [], []
+    columns = []
+
+    def add_row(cells):
+        line, row_spans = "", []
+        for i, cell in enumerate(cells):
+            if i:
+                line += CELL_SEPARATOR
+            row_spans.append((len(line), len(line) + len(cell), columns[i] if i < len(columns) else None))
+            line += cell
+        lines.append(line)
+        spans.append(row_spans)
+
+    for raw in raw_lines:
+        if is_grid_line(raw):
+            try:
+                grid = json.loads(raw)
+            except ValueError:
+                continue
+            columns = grid.get("columns") or []
+            for row in grid.get("rows") or []:
+                add_row(row)
+            continue
+        if is_table_header(raw):
+            # Every page (and every continuation chunk) starts its table with a header line
+            columns = raw.split("\t")
+        else:
+            add_row(raw.split("\t"))
+    return lines, spans
+
+def cell_index(row_spans, start, end):
+    """Index of the table cell holding line[start:end], None outside any cell."""
+    for index, (cell_start, cell_end, _) in enumerate(row_spans):
+        if cell_start <= start and end <= cell_end:
+            return index
+    return None
+
+def _full_date(day, month, year):
+    year = int(year)
+    if year < 100:
+        year += 2000
+    return f"{year:04d}-{int(month):02d}-{int(day):02d}"
+
+# ----- Bank Templates -----
+class BankTemplate:
+    """Fixed-layout parser for one bank: transaction lines start with a DD<sep>MM operation date,
+    amounts are French decimals and debit/credit is read from the column they sit in."""
+
+    def __init__(self, name, bank_name, keywords, date_sep="/",
+                 opening_labels=("ANCIEN SOLDE", "SOLDE PRECEDENT", "SOLDE CREDITEUR AU", "SOLDE DEBITEUR AU"),
+                 closing_labels=("NOUVEAU SOLDE", "SOLDE FINAL", "SOLDE CREDITEUR AU", "SOLDE DEBITEUR AU"),
+                 credit_keywords=DEFAULT_CREDIT_KEYWORDS):
+        self.name = name
+        self.bank_name = bank_name
+        self.keywords = keywords
+        self.date_re = re.compile(rf"^\s*\W{{0,3}}(\d{{2}}){re.escape(date_sep)}(\d{{2}})(?:{re.escape(date_sep)}(\d{{2,4}}))?\b")
+        self.opening_labels = opening_labels
+        self.closing_labels = closing_labels
+        self.credit_keywords = credit_keywords
+
+    def matches_path(self, path):
+        """True when one of the file's folders is named after this bank (the dataset layout)."""
+        return self.name.lower() in (part.lower() for part in os.path.normpath(path).split(os.sep))
+
+    def matches(self, text):
+        """True when a bank keyword appears in the text."""
+        upper = normalize_line(text)
+        return any(keyword in upper for keyword in self.keywords)
+
+    # ----- Header Fields -----
+    def _columns(self, lines):
+        """Centre offsets of the debit/credit/balance header words, from the last header line."""
+        columns = {}
+        for line in lines:
+            found = {}
+            for m in re.finditer(r"\S+", line):
+                word = normalize_line(m.group()).lower().strip(".:")
+                for field in ("debit", "credit", "balance"):
+                    if word in HEADER_KEYWORDS[field] and field not in found:
+                        found[field] = (m.start() + m.end()) / 2
+            if "debit" in found and "credit" in found:
+                columns = found
+        return columns
+
+    def _statement_year_end(self, upper):
+        """Latest full date in the statement, used to give DD/MM operation dates their year."""
+        dates = []
+        for day, month, year in FULL_DATE_RE.findall(upper):
+            if 1 <= int(day) <= 31 and 1 <= int(month) <= 12:
+                dates.append(_full_date(day, month, year))
+        return max(dates) if dates else None
+
+    def _balance(self, lines, labels, reverse=False):
+        """Signed amount on (or right below) the first line carrying one of labels."""
+        indices = range(len(lines) - 1, -1, -1) if reverse else range(len(lines))
+        for i in indices:
+            if not any(label in lines[i] for label in labels):
+                continue
+            for candidate in lines[i:i + 2]:
+                amounts = AMOUNT_RE.findall(candidate)
+                if amounts:
+                    value = parse_amount(amounts[-1])
+                    return (-value if "DEBITEUR" in lines[i] else value), i
+        return None, None
+
+    # ----- Transactions -----
+    def _classify(self, start, end, columns, description):
+        """'debit', 'credit' or 'balance' for the amount spanning line[start:end]."""
+        if columns:
+            centre = (start + end) / 2
+            return min(columns, key=lambda field: abs(columns[field] - centre))
+        upper = normalize_line(description)
+        return "credit" if any(keyword in upper for keyword in self.credit_keywords) else "debit"
+
+    def parse(self, text):
+        """Return (data, confidence) in the parse_structured_data schema."""
+        table = table_lines(text)
+        if table is None:
+            lines, spans = text.splitlines(), None
+            columns = self._columns(lines)
+        else:
+            # TSV/grid cells are already named, character offsets mean nothing there
+            lines, spans = table
+            columns = {}
+        upper_lines = [normalize_line(line) for line in lines]
+        upper = "\n".join(upper_lines)
+        year_end = self._statement_year_end(upper)
+
+        opening, opening_line = self._balance(upper_lines, self.opening_labels)
+        closing, closing_line = self._balance(upper_lines, self.closing_labels, reverse=True)
+        if closing_line is not None and closing_line == opening_line:
+            closing = None
+
+        transactions = []
+        candidates = 0
+        current = None
+        for i, line in enumerate(lines):
+            if i in (opening_line, closing_line):
+                current = None
+                continue
+            match = self.date_re.match(line)
+            amounts = list(AMOUNT_RE.finditer(line))
+            cells = [cell_index(spans[i], m.start(), m.end()) if spans else None for m in amounts]
+            fields = [spans[i][c][2] if c is not None else None for c in cells]
+            ambiguous = False
+            if any(field in AMOUNT_FIELDS for field in fields):
+                # Named debit/credit/balance cells: ignore figures inside the label
+                amounts, cells, fields = zip(*[(m, c, f) for m, c, f in zip(amounts, cells, fields) if f in AMOUNT_FIELDS])
+                # Two amounts in one cell means columns were merged (e.g. credit + balance)
+                # and the cell name cannot say which figure is which
+                ambiguous = len(set(cells)) < len(cells)
+            if match:
+                candidates += 1
+                day, month, year = match.groups()
+                if not (1 <= int(day) <= 31 and 1 <= int(month) <= 12):
+                    current = None
+                    continue
+                rest = line[match.end():amounts[0].start() if amounts else len(line)]
+                # Drop the value date and separators printed next to the label
+                description = re.sub(r"\d{2}[/.]\d{2}(?:[/.]\d{2,4})?|\|", " ", rest)
+                current = {"day": day, "month": month, "year": year,
+                           "description": " ".join(description.split()), "amounts": []}
+                transactions.append(current)
+            elif current is None:
+                continue
+            elif not amounts:
+                # Label continued on the next line
+                if not current["amounts"]:
+                    current["description"] = " ".join((current["description"] + " " + line.replace("|", " ")).split())
+                continue
+            if current is not None and not current["amounts"]:
+                if not match:
+                    prefix = line[:amounts[0].start()].replace("|", " ")
+                    current["description"] = " ".join((current["description"] + " " + prefix).split())
+                current["amounts"] = [(m.start(), m.end(), m.group(1), f) for m, f in zip(amounts, fields)]
+                current["ambiguous"] = ambiguous
+
+        rows = []
+        ambiguous = sum(1 for txn in transactions if txn.get("ambiguous"))
+        if ambiguous:
+            # Left out, so they lower the confidence and the balances no longer add up
+            print(f"⚠️ Template {self.name}: {ambiguous} row(s) with several amounts in one table cell.")
+        for txn in transactions:
+            if not txn["amounts"] or not txn["description"] or txn.get("ambiguous"):
+                continue
+            row = self._build_row(txn, columns, year_end)
+            if row:
+                rows.append(row)
+
+        confidence = len(rows) / candidates if candidates else 0.0
+        data = {
+            "account_number": self._account_number(upper),
+            "bank_name": self.bank_name,
+            "account_holder": None,
+            "statement_period": self._period(upper),
+            "opening_balance": opening,
+            "closing_balance": closing,
+            "transactions": rows
+        }
+        return data, confidence
+
+    def _build_row(self, txn, columns, year_end):
+        amount = balance = None
+        for start, end, value, field in txn["amounts"]:
+            if field not in AMOUNT_FIELDS:
+                field = self._classify(start, end, columns, txn["description"])
+            if field == "balance":
+                balance = parse_amount(value)
+            elif amount is None:
+                amount = parse_amount(value) if field == "credit" else -parse_amount(value)
+        if amount is None:
+            return None
+
+        day, month, year = txn["day"], txn["month"], txn["year"]
+        if year:
+            date = _full_date(day, month, year)
+        elif year_end:
+            end_year, end_month = int(year_end[:4]), int(year_end[5:7])
+            # A December operation on a January statement belongs to the previous year
+            date = _full_date(day, month, end_year if int(month) <= end_month else end_year - 1)
+        else:
+            return None
+        return {
+            "date": date,
+            "description": txn["description"],
+            "amount": amount,
+            "balance": balance,
+            "transaction_type": "credit" if amount >= 0 else "debit"
+        }
+
+    def _account_number(self, upper):
+        match = ACCOUNT_RE.search(upper)
+        return match.group(1).replace(" ", "") if match else None
+
+    def _period(self, upper):
+        match = PERIOD_RE.search(upper)
+        if not match:
+            return None
+        start, end = (FULL_DATE_RE.match(d) for d in match.groups())
+        if not start or not end:
+            return None
+        return f"{_full_date(*start.groups())} to {_full_date(*end.groups())}"
+
+TEMPLATES = []
+
+def register_template(template):
+    """Add a bank template; later registrations take priority over earlier ones."""
+    TEMPLATES.insert(0, template)
+    return template
+
+for _template in (
+    BankTemplate("LCL", "LCL", ("LCL", "CREDIT LYONNAIS"), date_sep="."),
+    BankTemplate("banquepopulaire", "Banque Populaire", ("BANQUE POPULAIRE",)),
+    BankTemplate("caisseepargne", "Caisse d'Epargne", ("CAISSE D'EPARGNE", "CAISSE DEPARGNE")),
+    BankTemplate("creditMutuel", "Crédit Mutuel", ("CREDIT MUTUEL", "CMB.FR", "CREDITMUTUEL")),
+    BankTemplate("creditagricol", "Crédit Agricole", ("CREDIT AGRICOLE", "CREDITAGRICOLE")),
+    BankTemplate("creditdunord", "Crédit du Nord", ("CREDIT DU NORD", "CREDIT-DU-NORD")),
+    BankTemplate("laposte", "La Banque Postale", ("BANQUE POSTALE", "LABANQUEPOSTALE")),
+    BankTemplate("quonto", "Qonto", ("QONTO",)),
+    BankTemplate("societegenerale", "Société Générale", ("SOCIETE GENERALE", "SOCIETEGENERALE")),
+):
+    register_template(_template)
+
+def get_template(name):
+    return next((template for template in TEMPLATES if template.name == name), None)
+
+def find_template(text, path=None, name=None):
+    """The first registered template matching the file's folder, else the named template
+    (e.g. remembered for the page layout, a fuzzier signal), then one matching the text."""
+    if path:
+        for template in TEMPLATES:
+            if template.matches_path(path):
+                return template
+    if name and get_template(name):
+        return get_template(name)
+    for template in TEMPLATES:
+        if template.matches(text):
+            return template
+    return None
+
+# ----- Validation -----
+def balance_check(data, tolerance=BALANCE_TOLERANCE):
+    """Opening balance plus all movements must land on the closing balance,
+    and every printed running balance must follow from the one before it."""
+    opening, closing = data.get("opening_balance"), data.get("closing_balance")
+    transactions = data.get("transactions") or []
+    if opening is None or closing is None or not transactions:
+        return False
+    if abs(opening + sum(t["amount"] for t in transactions) - closing) > tolerance:
+        return False
+    running = opening
+    for txn in transactions:
+        running += txn["amount"]
+        if txn["balance"] is not None and abs(abs(running) - txn["balance"]) > tolerance:
+            return False
+    return True
+
+def parse_with_template(text, path=None, min_confidence=MIN_TEMPLATE_CONFIDENCE, template_name=None):
+    """Parse statement text locally. Returns the parsed dict, or None when no template matches,
+    its confidence is below min_confidence or the balances do not add up (caller falls back to GPT)."""
+    if not TEMPLATES_ENABLED or not text or not text.strip():
+        return None
+    template = find_template(text, path, template_name)
+    if template is None:
+        return None
+    try:
+        data, confidence = template.parse(text)
+    except Exception as e:
+        print(f"⚠️ Template {template.name} failed: {e}")
+        return None
+    if confidence < min_confidence:
+        print(f"↩️ Template {template.name} confidence {confidence:.2f} < {min_confidence:.2f}, falling back to GPT.")
+        return None
+    if not balance_check(data):
+        print(f"↩️ Template {template.name} balance check failed, falling back to GPT.")
+        return None
+    print(f"⚡ Parsed locally with the {template.name} template ({len(data['transactions'])} transactions).")
+    return data
@@ -0,0 +1,236 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import tempfile
+import threading
+from contextlib import contextmanager
+
+# ----- Cache Settings -----
+CACHE_DIR = os.getenv("GMI_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache"))
+CACHE_ENABLED = os.getenv("GMI_CACHE", "1") != "0"
+OCR_CACHE_MAX_BYTES = int(os.getenv("GMI_OCR_CACHE_MAX_MB", "512")) * 1024 * 1024
+
+# Bump when the cached value format changes
+CACHE_VERSION = "2"
+
+# ----- Keys -----
+def make_key(*parts):
+    """Hash raw bytes and parameters into a stable content-addressed key."""
+    h = hashlib.sha256(CACHE_VERSION.encode())
+    for part in parts:
+        if not isinstance(part, bytes):
+            part = repr(part).encode("utf-8")
+        h.update(len(part).to_bytes(8, "little"))
+        h.update(part)
+    return h.hexdigest()
+
+def image_key(image, *params):
+    """Key for a NumPy/PIL image: pixel bytes, shape and dtype plus the given parameters."""
+    if hasattr(image, "tobytes") and hasattr(image, "shape"):
+        return make_key(image.tobytes(), image.shape, str(image.dtype), *params)
+    return make_key(image.tobytes(), image.size, image.mode, *params)
+
+# ----- Hit Counters -----
+class CacheStats:
+    """Thread-safe hit/miss counters shared by the cache backends."""
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def record(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def summary(self, name):
+        total = self.hits + self.misses
+        rate = (self.hits / total * 100) if total else 0.0
+        return f"{name}: {self.hits} hits / {self.misses} misses ({rate:.0f}% hit rate)"
+
+# ----- File Cache -----
+class FileCache:
+    """JSON values stored one file per key, capped at max_bytes with least-recently-used eviction.
+    Entries older than ttl seconds (if set) are treated as misses and removed."""
+
+    def __init__(self, directory, max_bytes=OCR_CACHE_MAX_BYTES, enabled=CACHE_ENABLED, ttl=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self.ttl = ttl
+        self.stats = CacheStats()
+        self._size = None
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], f"{key}.json")
+
+    def get(self, key, default=None):
+        if not self.enabled:
+            return default
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            self.stats.record(False)
+            return default
+        if self.ttl is not None and time.time() - entry["created"] > self.ttl:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            self.stats.record(False)
+            return default
+        self.stats.record(True)
+        # Touch on read so eviction drops the least recently used entries first
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return entry["value"]
+
+    def set(self, key, value):
+        if not self.enabled:
+            return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write then rename so concurrent workers never read a half-written entry
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump({"created": time.time(), "value": value}, f, ensure_ascii=False)
+            size = os.path.getsize(tmp_path)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"⚠️ Could not write cache entry {key}: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+
+        if self._size is None:
+            self._size = self._scan_size()
+        else:
+            self._size += size
+        if self._size > self.max_bytes:
+            self.evict()
+
+    def _entries(self):
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if not name.endswith(".json"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def _scan_size(self):
+        return sum(size for _, size, _ in self._entries())
+
+    def evict(self):
+        """Delete least recently used entries until the cache is back under 90% of its cap."""
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        target = int(self.max_bytes * 0.9)
+        removed = 0
+        for _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        self._size = total
+        if removed:
+            print(f"🧹 Evicted {removed} cache entries from {self.directory}")
+
+    def clear(self):
+        for _, _, path in self._entries():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self._size = 0
+
+# ----- SQLite Cache -----
+@contextmanager
+def sqlite_connect(path, timeout=30):
+    """Short-lived connection that commits (or rolls back) and closes on exit. One connection
+    per call keeps the SQLite files safe across threads and processes."""
+    conn = sqlite3.connect(path, timeout=timeout)
+    try:
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+class SQLiteCache:
+    """JSON values in a single SQLite file, capped at max_entries with LRU eviction and an optional ttl."""
+
+    def __init__(self, path, max_entries=10000, enabled=CACHE_ENABLED, ttl=None):
+        self.path = path
+        self.max_entries = max_entries
+        self.enabled = enabled
+        self.ttl = ttl
+        self.stats = CacheStats()
+        if self.enabled:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            with sqlite_connect(self.path) as conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS entries ("
+                    "key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)"
+                )
+                conn.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)")
+
+    def get(self, key, default=None):
+        if not self.enabled:
+            return default
+        now = time.time()
+        with sqlite_connect(self.path) as conn:
+            row = conn.execute("SELECT value, created FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None or (self.ttl is not None and now - row[1] > self.ttl):
+                if row is not None:
+                    conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                self.stats.record(False)
+                return default
+            conn.execute("UPDATE entries SET accessed = ? WHERE key = ?", (now, key))
+        self.stats.record(True)
+        return json.loads(row[0])
+
+    def set(self, key, value):
+        if not self.enabled:
+            return
+        now = time.time()
+        with sqlite_connect(self.path) as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO entries (key, value, created, accessed) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value, ensure_ascii=False), now, now)
+            )
+        self.evict()
+
+    def evict(self):
+        """Drop expired entries, then least recently used ones beyond max_entries."""
+        with sqlite_connect(self.path) as conn:
+            if self.ttl is not None:
+                conn.execute("DELETE FROM entries WHERE created < ?", (time.time() - self.ttl,))
+            conn.execute(
+                "DELETE FROM entries WHERE key IN ("
+                "SELECT key FROM entries ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+
+    def clear(self):
+        if self.enabled:
+            with sqlite_connect(self.path) as conn:
+                conn.execute("DELETE FROM entries")
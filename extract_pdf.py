@@ -1,20 +1,42 @@
 import os
 import fitz  # PyMuPDF
 import cv2
-from pdf2image import convert_from_path
-from extract_ocr import extract_text_ocr
-from preprocess import preprocess_document
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, as_completed, wait
+import pypdfium2 as pdfium
+from extract_ocr import extract_text, extract_text_ocr, PAGE_BREAK
+from preprocess import PreprocessGraph
 
-def extract_text_pdf(pdf_path, multiple_pages=True, max_page_count=3, max_tokens=16000, lang='eng'):
+# ----- Native Text Layout -----
+def page_words_to_data(page):
+    """PyMuPDF word boxes in the same {'value', 'coordinates'} shape extract_text_ocr builds from Tesseract."""
+    data = []
+    for x0, y0, x1, y1, word, *_ in page.get_text("words"):
+        word = word.strip()
+        if word:
+            data.append({'value': word, 'coordinates': [x0, y0, x1, y1]})
+    return data
+
+def extract_page_layout_text(page, add_spaces=True, max_tokens=16000, layout="spaces"):
+    """Rebuild column-aligned lines (or table cells, see extract_text) from the page's word coordinates."""
+    return extract_text(page_words_to_data(page), add_spaces, max_tokens, layout=layout)
+
+def extract_text_pdf(pdf_path, multiple_pages=True, max_page_count=3, max_tokens=16000, lang='eng', layout="spaces",
+                     strict=False):
     """
     Direct PDF text extraction without OCR using PyMuPDF.
     Good for searchable PDFs.
+    Lines are rebuilt from word coordinates so table columns stay aligned
+    ("spaces", "tsv" or "grid", see extract_text); layout="raw" keeps get_text("text").
+    With strict, a PDF that cannot be opened raises instead of returning "".
     """
-    text = ""
+    page_texts = []
     try:
         doc = fitz.open(pdf_path)
     except Exception as e:
         print(f"❌ Could not open PDF: {pdf_path} — {e}")
+        if strict:
+            raise
         return ""
 
     page_count = len(doc)
@@ -22,67 +44,299 @@ def extract_text_pdf(pdf_path, multiple_pages=True, max_page_count=3, max_tokens
 
     for page_num in range(pages_to_process):
         page = doc.load_page(page_num)
-        page_text = page.get_text("text")
-        text += page_text + "\n"
+        if layout == "raw":
+            page_text = page.get_text("text")
+        else:
+            page_text = extract_page_layout_text(page, max_tokens=max_tokens, layout=layout)
+        page_texts.append(page_text)
 
     doc.close()
+    text = f"\n{PAGE_BREAK}\n".join(page_texts)
 
     if not text.strip():
         print("⚠️ No text found in PDF — it might be scanned. Try OCR method.")
     return text.strip()
 
-def extract_text_pdf_with_preprocessing(pdf_path, output_dir, max_page_count=None, max_tokens=16000, lang='eng'):
+def _process_pdf_page(i, image, page_count, pdf_images_dir, corrected_dir, max_tokens, lang, layout="spaces"):
+    """Deskew and OCR one PDF page in memory. Returns the page text, or None if the page failed.
+    Raw and corrected pages are only written out when the debug dirs are given."""
+    print(f"🔄 Processing page {i}/{page_count}...")
+
+    if image is None:
+        print(f"❌ Error processing page {i}: page could not be rendered")
+        return None
+
+    if pdf_images_dir:
+        page_image_path = os.path.join(pdf_images_dir, f"page_{i}.jpg")
+        image.save(page_image_path, "JPEG")
+        print(f"💾 Page {i} saved as image: {page_image_path}")
+
+    # Preprocess image (deskew, enhance)
+    try:
+        graph = PreprocessGraph(image)
+        print(f"✅ Skew corrected. Angle: {graph.angle:.2f}°")
+
+        if corrected_dir:
+            corrected_image_path = os.path.join(corrected_dir, f"corrected_page_{i}.jpg")
+            cv2.imwrite(corrected_image_path, graph.deskewed)
+            print(f"📷 Corrected page {i} saved: {corrected_image_path}")
+
+        # Run OCR on the deskewed gray stage
+        return extract_text_ocr(graph.deskewed_gray, add_spaces=True, max_tokens=max_tokens, lang=lang, layout=layout)
+
+    except Exception as e:
+        print(f"❌ Error processing page {i}: {e}")
+        return None
+
+# ----- Page Rasterization -----
+# Rendering resolution for OCR: a fixed DPI, or "auto" to size each page from its measured glyph height
+PDF_DPI = os.getenv("GMI_PDF_DPI", "300")
+DEFAULT_DPI = 300
+PROBE_DPI = 100
+# Median connected-component height (px) to aim for: roughly 10pt text at 300 DPI,
+# where Tesseract's accuracy is at its best; smaller print loses accuracy quickly
+TARGET_GLYPH_HEIGHT = 22
+MIN_DPI, MAX_DPI = 150, 400
+MIN_GLYPHS = 20
+
+def median_glyph_height(image):
+    """Median height (px) of glyph-sized connected components on a page, None if too few are found."""
+    gray = np.asarray(image.convert("L"))
+    _, binary = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    _, _, stats, _ = cv2.connectedComponentsWithStats(binary, connectivity=8)
+    heights = stats[1:, cv2.CC_STAT_HEIGHT]
+    widths = stats[1:, cv2.CC_STAT_WIDTH]
+    # Skip specks, rules, frames and pictures; keep shapes a letter could have
+    glyphs = heights[(heights >= 3) & (heights <= gray.shape[0] // 20) & (widths <= 3 * heights)]
+    if len(glyphs) < MIN_GLYPHS:
+        return None
+    return float(np.median(glyphs))
+
+def choose_dpi(page, probe_dpi=PROBE_DPI, target=TARGET_GLYPH_HEIGHT):
+    """Render a low-DPI probe of a pdfium page and return the DPI that brings its median
+    glyph height to target pixels, clamped to [MIN_DPI, MAX_DPI] and rounded to 10."""
+    height = median_glyph_height(page.render(scale=probe_dpi / 72).to_pil())
+    if height is None:
+        return DEFAULT_DPI
+    dpi = probe_dpi * target / height
+    return int(round(min(MAX_DPI, max(MIN_DPI, dpi)) / 10) * 10)
+
+def pdf_page_count(pdf_path):
+    pdf = pdfium.PdfDocument(pdf_path)
+    try:
+        return len(pdf)
+    finally:
+        pdf.close()
+
+def iter_pdf_pages(pdf_path, dpi=300, max_page_count=None, page_numbers=None):
     """
-    Convert PDF to images, preprocess, then run OCR on each page.
-    Good for scanned PDFs.
+    Render PDF pages one at a time with pypdfium2, yielding (page_number, PIL image).
+    Only the requested pages (1-based page_numbers, or the first max_page_count) are ever
+    rendered, and each bitmap can be freed before the next page is drawn.
+    dpi="auto" picks each page's resolution from a low-DPI probe (choose_dpi).
+    A page that fails to render is yielded as (page_number, None).
     """
-    os.makedirs(output_dir, exist_ok=True)
+    pdf = pdfium.PdfDocument(pdf_path)
+    try:
+        if page_numbers is None:
+            page_count = len(pdf)
+            if max_page_count:
+                page_count = min(page_count, max_page_count)
+            page_numbers = range(1, page_count + 1)
+
+        for page_number in page_numbers:
+            try:
+                page = pdf[page_number - 1]
+                try:
+                    page_dpi = dpi
+                    if dpi == "auto":
+                        page_dpi = choose_dpi(page)
+                        print(f"🔎 Page {page_number}: rendering at {page_dpi} DPI")
+                    image = page.render(scale=int(page_dpi) / 72).to_pil()
+                finally:
+                    page.close()
+            except Exception as e:
+                print(f"❌ Error rendering page {page_number}: {e}")
+                image = None
+            yield page_number, image
+    finally:
+        pdf.close()
+
+def ocr_pdf_pages(pdf_path, page_numbers, page_count, pdf_images_dir, corrected_dir, max_tokens, lang,
+                  page_workers=None, layout="spaces", dpi=PDF_DPI):
+    """Render and OCR the given 1-based pages, return {page_number: text or None}.
+    With page_workers > 1 pages run on a process pool with at most 2 pages per worker rendered ahead."""
+    page_numbers = list(page_numbers)
+    pages = iter_pdf_pages(pdf_path, dpi=dpi, page_numbers=page_numbers)
+    page_texts = {}
+
+    if page_workers and page_workers > 1 and len(page_numbers) > 1:
+        def collect(future, i):
+            try:
+                page_texts[i] = future.result()
+            except Exception as e:
+                print(f"❌ Error processing page {i}: {e}")
+                page_texts[i] = None
+
+        max_in_flight = 2 * page_workers
+        with ProcessPoolExecutor(max_workers=min(page_workers, len(page_numbers))) as pool:
+            in_flight = {}
+            for i, image in pages:
+                # Bound the number of rendered pages held in memory at once
+                if len(in_flight) >= max_in_flight:
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        collect(future, in_flight.pop(future))
+                future = pool.submit(
+                    _process_pdf_page, i, image, page_count, pdf_images_dir, corrected_dir, max_tokens, lang, layout
+                )
+                in_flight[future] = i
+                del image
+            for future in as_completed(in_flight):
+                collect(future, in_flight[future])
+    else:
+        for i, image in pages:
+            page_texts[i] = _process_pdf_page(i, image, page_count, pdf_images_dir, corrected_dir, max_tokens, lang, layout)
+
+    return page_texts
+
+def join_page_texts(pdf_path, page_texts, strict=False):
+    """Page texts in page order, separated by PAGE_BREAK lines. Failed pages (None) are left out,
+    or raise with strict."""
+    failed = [i for i in sorted(page_texts) if page_texts[i] is None]
+    if failed and strict:
+        raise RuntimeError(f"{len(failed)} page(s) of {pdf_path} failed: {failed}")
+    return f"\n{PAGE_BREAK}\n".join(page_texts[i] for i in sorted(page_texts) if page_texts[i] is not None)
+
+def _debug_dirs(output_dir, pdf_path):
+    """Create and return (raw, corrected) page dump dirs, or (None, None) when dumps are off."""
+    if not output_dir:
+        return None, None
     pdf_name = os.path.splitext(os.path.basename(pdf_path))[0]
 
+    pdf_images_dir = os.path.join(output_dir, "pdf_images", pdf_name)
+    os.makedirs(pdf_images_dir, exist_ok=True)
+
+    corrected_dir = os.path.join(output_dir, "corrected_pdf_images", pdf_name)
+    os.makedirs(corrected_dir, exist_ok=True)
+    return pdf_images_dir, corrected_dir
+
+def extract_text_pdf_with_preprocessing(pdf_path, output_dir=None, max_page_count=None, max_tokens=16000, lang='eng',
+                                        page_workers=None, layout="spaces", dpi=PDF_DPI, strict=False):
+    """
+    Convert PDF to images, preprocess, then run OCR on each page.
+    Good for scanned PDFs.
+    Pages are rendered one at a time and stay in memory; pass output_dir to also dump
+    raw and corrected page images for debugging.
+    With page_workers > 1 pages are OCR'd on a process pool (at most 2 pages per worker
+    rendered ahead) and joined back in page order.
+    dpi is a fixed resolution or "auto" for a per-page resolution from the measured glyph height.
+    With strict, an unreadable PDF or any failed page raises instead of being left out.
+    """
     try:
-        images = convert_from_path(pdf_path, dpi=300)
+        total_pages = pdf_page_count(pdf_path)
     except Exception as e:
-        print(f"❌ Error converting PDF to images: {e}")
+        print(f"❌ Error opening PDF for rendering: {e}")
+        if strict:
+            raise
         return ""
 
-    page_count = len(images)
+    page_count = total_pages
     if max_page_count:
         page_count = min(page_count, max_page_count)
 
-    print(f"📄 PDF has {len(images)} pages. Processing {page_count} pages...")
+    print(f"📄 PDF has {total_pages} pages. Processing {page_count} pages...")
 
-    all_text = ""
-    pdf_images_dir = os.path.join(output_dir, "pdf_images", pdf_name)
-    os.makedirs(pdf_images_dir, exist_ok=True)
+    pdf_images_dir, corrected_dir = _debug_dirs(output_dir, pdf_path)
 
-    corrected_dir = os.path.join(output_dir, "corrected_pdf_images", pdf_name)
-    os.makedirs(corrected_dir, exist_ok=True)
+    page_texts = ocr_pdf_pages(
+        pdf_path, range(1, page_count + 1), page_count, pdf_images_dir, corrected_dir,
+        max_tokens, lang, page_workers=page_workers, layout=layout, dpi=dpi
+    )
 
-    for i, image in enumerate(images[:page_count], start=1):
-        print(f"🔄 Processing page {i}/{page_count}...")
+    all_text = join_page_texts(pdf_path, page_texts, strict)
 
-        # Save raw image
-        page_image_path = os.path.join(pdf_images_dir, f"page_{i}.jpg")
-        image.save(page_image_path, "JPEG")
-        print(f"💾 Page {i} saved as image: {page_image_path}")
+    print("✅ PDF processing complete. Total text length:", len(all_text))
+    return all_text.strip()
 
-        # Preprocess image (deskew, enhance)
-        try:
-            cv_img = cv2.imread(page_image_path)
-            angle, corrected_image = preprocess_document(cv_img)
-            print(f"✅ Skew corrected. Angle: {angle:.2f}°")
+# ----- Hybrid Text Layer / OCR -----
+# A page's text layer is trusted when it has at least this many visible characters...
+MIN_TEXT_LAYER_CHARS = 50
+# ...and at least this fraction of them are real printable characters. Fonts without a
+# ToUnicode map come out as control characters or U+FFFD and fail this check.
+MIN_TEXT_LAYER_QUALITY = 0.9
+# ...and images cover at most this share of the page. A scan with a digital header or
+# footer stamped on it has a clean text layer too, but the table is only in the image.
+MAX_IMAGE_COVERAGE = 0.5
 
-            corrected_image_path = os.path.join(corrected_dir, f"corrected_page_{i}.jpg")
-            cv2.imwrite(corrected_image_path, corrected_image)
-            print(f"📷 Corrected page {i} saved: {corrected_image_path}")
+def text_layer_quality(text):
+    """Fraction of non-whitespace characters that are printable and not replacement/private-use glyphs."""
+    chars = [c for c in text if not c.isspace()]
+    if not chars:
+        return 0.0
+    good = sum(1 for c in chars if c.isprintable() and c != "\ufffd" and not ("\ue000" <= c <= "\uf8ff"))
+    return good / len(chars)
 
-            # Run OCR
-            ocr_text = extract_text_ocr(corrected_image_path, add_spaces=True, max_tokens=max_tokens, lang=lang)
-            all_text += ocr_text + "\n"
+def image_coverage(page):
+    """Share of the page area covered by placed images (overlaps counted once per image, capped at 1)."""
+    page_rect = page.rect
+    if page_rect.is_empty:
+        return 0.0
+    covered = 0.0
+    for info in page.get_image_info():
+        rect = fitz.Rect(info["bbox"]) & page_rect
+        if not rect.is_empty:
+            covered += rect.width * rect.height
+    return min(1.0, covered / (page_rect.width * page_rect.height))
 
-        except Exception as e:
-            print(f"❌ Error processing page {i}: {e}")
-            continue
+def is_usable_text_layer(text, min_chars=MIN_TEXT_LAYER_CHARS, min_quality=MIN_TEXT_LAYER_QUALITY,
+                         coverage=0.0, max_coverage=MAX_IMAGE_COVERAGE):
+    visible = sum(1 for c in text if not c.isspace())
+    return visible >= min_chars and text_layer_quality(text) >= min_quality and coverage <= max_coverage
+
+def extract_text_pdf_hybrid(pdf_path, output_dir=None, max_page_count=None, max_tokens=16000, lang='eng',
+                            page_workers=None, min_chars=MIN_TEXT_LAYER_CHARS, min_quality=MIN_TEXT_LAYER_QUALITY,
+                            layout="spaces", dpi=PDF_DPI, strict=False):
+    """
+    Per-page routing: keep PyMuPDF's text layer where it is present and clean (laid out
+    from word coordinates like OCR output), rasterize + OCR only the pages whose text
+    layer is missing or garbled, or that are mostly a scanned image.
+    With strict, an unreadable PDF or any failed page raises instead of being left out.
+    """
+    try:
+        doc = fitz.open(pdf_path)
+    except Exception as e:
+        print(f"❌ Could not open PDF: {pdf_path} — {e}")
+        if strict:
+            raise
+        return ""
+
+    page_count = len(doc)
+    if max_page_count:
+        page_count = min(page_count, max_page_count)
+
+    page_texts = {}
+    ocr_pages = []
+    try:
+        for page_num in range(page_count):
+            page = doc.load_page(page_num)
+            if is_usable_text_layer(page.get_text("text"), min_chars, min_quality, image_coverage(page)):
+                page_texts[page_num + 1] = extract_page_layout_text(page, max_tokens=max_tokens, layout=layout)
+            else:
+                ocr_pages.append(page_num + 1)
+    finally:
+        doc.close()
+
+    print(f"📄 PDF has {page_count} pages to process: {len(page_texts)} from text layer, {len(ocr_pages)} via OCR.")
+
+    if ocr_pages:
+        pdf_images_dir, corrected_dir = _debug_dirs(output_dir, pdf_path)
+        page_texts.update(ocr_pdf_pages(
+            pdf_path, ocr_pages, page_count, pdf_images_dir, corrected_dir,
+            max_tokens, lang, page_workers=page_workers, layout=layout, dpi=dpi
+        ))
+
+    all_text = join_page_texts(pdf_path, page_texts, strict)
 
     print("✅ PDF processing complete. Total text length:", len(all_text))
     return all_text.strip()
@@ -96,6 +350,10 @@ if __name__ == "__main__":
     text1 = extract_text_pdf(test_pdf, multiple_pages=True, max_page_count=2)
     print(text1[:500])
 
+    print("\n---- TESTING HYBRID PDF EXTRACTION ----")
+    text3 = extract_text_pdf_hybrid(test_pdf, max_page_count=2, lang='eng')
+    print(text3[:500])
+
     print("\n---- TESTING OCR PDF EXTRACTION ----")
-    text2 = extract_text_pdf_with_preprocessing(test_pdf, output_dir, max_page_count=2, lang='eng')
+    text2 = extract_text_pdf_with_preprocessing(test_pdf, output_dir, max_page_count=2, lang='eng', page_workers=2)
     print(text2[:500])
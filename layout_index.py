@@ -0,0 +1,185 @@
+import os
+import re
+import json
+import time
+import cv2
+import numpy as np
+from cache import CACHE_DIR, CACHE_ENABLED, FileCache, image_key, sqlite_connect
+from extract_ocr import ocr_word_boxes
+from ocr_backends import get_ocr_backend
+
+# ----- Layout Settings -----
+LAYOUT_INDEX_PATH = os.getenv("GMI_LAYOUT_INDEX", os.path.join(CACHE_DIR, "layouts.sqlite3"))
+# Largest fingerprint distance (0 identical .. 1 unrelated) still counted as the same layout
+MAX_LAYOUT_DISTANCE = float(os.getenv("GMI_LAYOUT_MAX_DISTANCE", "0.45"))
+HEADER_FRACTION = 0.2    # top share of the page that carries the bank's letterhead
+HASH_SHAPE = (32, 16)    # width x height of the average-hash thumbnail = 512 bits
+HASH_WEIGHT = 0.6        # share of the distance from the header hash, the rest from anchor words
+MAX_ANCHOR_WORDS = 30
+
+# Settings a layout starts with. learn_layout narrows the skew limit and remembers the parser;
+# "ocr" is applied per layout but only changes when edited in the index by hand
+DEFAULT_LAYOUT_SETTINGS = {
+    "preprocess": {"delta": 1, "limit": 15},
+    "ocr": {"min_conf": 50, "config": ""},
+    "parser": None,
+}
+
+# ----- Fingerprints -----
+def header_region(image, fraction=HEADER_FRACTION):
+    """Grayscale top strip of a BGR or grayscale page."""
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+    return gray[:max(1, int(gray.shape[0] * fraction))]
+
+def average_hash(gray, shape=HASH_SHAPE):
+    """Average hash: thumbnail pixels brighter than the thumbnail mean. Separated the dataset's
+    bank letterheads better than a difference hash, which mostly picks up scan noise."""
+    small = cv2.resize(gray, shape, interpolation=cv2.INTER_AREA)
+    return (small > small.mean()).flatten()
+
+_anchor_cache = FileCache(os.path.join(CACHE_DIR, "anchors"))
+
+def anchor_words(gray, lang="eng", max_words=MAX_ANCHOR_WORDS, use_cache=True):
+    """Upper-cased alphabetic words OCR'd from the header strip (bank names, titles, column labels).
+    Cached by the strip's pixels, so a repeat run does not OCR the header again."""
+    height = gray.shape[0]
+    if height > 300:
+        gray = cv2.resize(gray, (gray.shape[1] * 300 // height, 300), interpolation=cv2.INTER_AREA)
+    key = image_key(gray, "anchors", lang, max_words, get_ocr_backend().name)
+    cached = _anchor_cache.get(key) if use_cache else None
+    if cached is not None:
+        return cached
+    words = []
+    for box in ocr_word_boxes(gray, lang=lang):
+        word = re.sub(r"[^A-Za-zÀ-ÿ]", "", box["value"]).upper()
+        if len(word) >= 4 and word not in words:
+            words.append(word)
+    words = sorted(words[:max_words])
+    if use_cache:
+        _anchor_cache.set(key, words)
+    return words
+
+def fingerprint_page(image, lang="eng"):
+    """Header hash plus anchor words for a page image (BGR or grayscale NumPy array)."""
+    if lang.lower() == "en":
+        lang = "eng"
+    header = header_region(image)
+    return {"hash": np.packbits(average_hash(header)).tobytes().hex(), "anchors": anchor_words(header, lang)}
+
+def fingerprint_distance(a, b, hash_weight=HASH_WEIGHT):
+    """Weighted mix of the normalised Hamming distance of the hashes and the Jaccard distance of the anchors."""
+    bits_a = np.unpackbits(np.frombuffer(bytes.fromhex(a["hash"]), dtype=np.uint8))
+    bits_b = np.unpackbits(np.frombuffer(bytes.fromhex(b["hash"]), dtype=np.uint8))
+    hamming = np.count_nonzero(bits_a != bits_b) / len(bits_a)
+    anchors_a, anchors_b = set(a["anchors"]), set(b["anchors"])
+    union = anchors_a | anchors_b
+    jaccard = 1 - len(anchors_a & anchors_b) / len(union) if union else 1.0
+    return hash_weight * hamming + (1 - hash_weight) * jaccard
+
+# ----- Layout Index -----
+class LayoutIndex:
+    """Known layouts in a SQLite file: fingerprint, settings and hit count per layout.
+    Lookups are a linear nearest-neighbour scan, which stays fast for the few hundred layouts a dataset has."""
+
+    def __init__(self, path=LAYOUT_INDEX_PATH, max_distance=MAX_LAYOUT_DISTANCE, enabled=CACHE_ENABLED):
+        self.path = path
+        self.max_distance = max_distance
+        self.enabled = enabled
+        if self.enabled:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            with sqlite_connect(self.path) as conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS layouts ("
+                    "id INTEGER PRIMARY KEY AUTOINCREMENT, fingerprint TEXT NOT NULL, settings TEXT NOT NULL, "
+                    "hits INTEGER NOT NULL DEFAULT 0, updated REAL NOT NULL)"
+                )
+
+    def nearest(self, fingerprint):
+        """(layout_id, settings, distance) of the closest known layout, or (None, None, None)."""
+        if not self.enabled:
+            return None, None, None
+        with sqlite_connect(self.path) as conn:
+            rows = conn.execute("SELECT id, fingerprint, settings FROM layouts").fetchall()
+        best = (None, None, None)
+        for layout_id, stored, settings in rows:
+            distance = fingerprint_distance(fingerprint, json.loads(stored))
+            if best[2] is None or distance < best[2]:
+                best = (layout_id, json.loads(settings), distance)
+        return best
+
+    def lookup(self, fingerprint):
+        """(layout_id, settings) of the matching layout within max_distance, or (None, None)."""
+        layout_id, settings, distance = self.nearest(fingerprint)
+        if layout_id is None or distance > self.max_distance:
+            return None, None
+        with sqlite_connect(self.path) as conn:
+            conn.execute("UPDATE layouts SET hits = hits + 1 WHERE id = ?", (layout_id,))
+        return layout_id, settings
+
+    def add(self, fingerprint, settings):
+        """Store a new layout and return its id."""
+        if not self.enabled:
+            return None
+        with sqlite_connect(self.path) as conn:
+            cursor = conn.execute(
+                "INSERT INTO layouts (fingerprint, settings, hits, updated) VALUES (?, ?, 1, ?)",
+                (json.dumps(fingerprint), json.dumps(settings), time.time())
+            )
+            return cursor.lastrowid
+
+    def update(self, layout_id, settings):
+        if not self.enabled or layout_id is None:
+            return
+        with sqlite_connect(self.path) as conn:
+            conn.execute("UPDATE layouts SET settings = ?, updated = ? WHERE id = ?",
+                         (json.dumps(settings), time.time(), layout_id))
+
+    def clear(self):
+        if self.enabled:
+            with sqlite_connect(self.path) as conn:
+                conn.execute("DELETE FROM layouts")
+
+_index = None
+
+def get_layout_index():
+    global _index
+    if _index is None:
+        _index = LayoutIndex()
+    return _index
+
+def default_settings():
+    return json.loads(json.dumps(DEFAULT_LAYOUT_SETTINGS))
+
+def route_page(image, lang="eng"):
+    """Fingerprint a page and return (layout_id, settings, fingerprint). Unknown layouts get the
+    default settings and layout_id None until learn_layout records them."""
+    index = get_layout_index()
+    if not index.enabled:
+        # Nothing to match against or learn into, skip the header OCR
+        return None, default_settings(), None
+    fingerprint = fingerprint_page(image, lang)
+    layout_id, settings = index.lookup(fingerprint)
+    if layout_id is None:
+        print("🧭 New layout, using default settings.")
+        return None, default_settings(), fingerprint
+    print(f"🧭 Layout #{layout_id} recognised, reusing its settings.")
+    return layout_id, settings, fingerprint
+
+def learn_layout(layout_id, settings, fingerprint, skew_angle=None, parser=None):
+    """Record what processing a page of this layout found: its skew keeps the search window
+    to what the layout needs and its parser is tried when the file's folder names no bank."""
+    index = get_layout_index()
+    if not index.enabled or fingerprint is None:
+        return layout_id
+    settings = json.loads(json.dumps(settings))
+    if skew_angle is not None:
+        observed = max(abs(skew_angle), settings.get("max_skew", 0.0))
+        settings["max_skew"] = observed
+        # Leave generous headroom: scans of the same layout still vary in how straight they are fed
+        settings["preprocess"]["limit"] = int(min(DEFAULT_LAYOUT_SETTINGS["preprocess"]["limit"], max(5, 2 * observed + 2)))
+    if parser:
+        settings["parser"] = parser
+    if layout_id is None:
+        return index.add(fingerprint, settings)
+    index.update(layout_id, settings)
+    return layout_id
@@ -0,0 +1,99 @@
+import os
+import json
+import time
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Canned parse result returned for every request
+STUB_RESPONSE = {
+    "account_number": "00000000000",
+    "bank_name": "Stub Bank",
+    "account_holder": None,
+    "statement_period": None,
+    "opening_balance": 100.0,
+    "closing_balance": 90.0,
+    "transactions": [
+        {"date": "2021-01-05", "description": "STUB PAYMENT", "amount": -10.0,
+         "balance": 90.0, "transaction_type": "debit"}
+    ]
+}
+
+def make_handler(latency=1.0, error_rate=0.0):
+    """Build a request handler that answers /chat/completions after `latency` seconds,
+    failing a random `error_rate` fraction of requests with 429 or 503."""
+
+    class StubHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def _send(self, status, payload, headers=None):
+            body = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length) or b"{}")
+            if not self.path.endswith("/chat/completions"):
+                self._send(404, {"error": {"message": f"Unknown path {self.path}"}})
+                return
+
+            time.sleep(latency)
+            if random.random() < error_rate:
+                if random.random() < 0.5:
+                    self._send(429, {"error": {"message": "Rate limit reached", "type": "rate_limit"}},
+                               headers={"retry-after": "0.5"})
+                else:
+                    self._send(503, {"error": {"message": "Service unavailable", "type": "server_error"}})
+                return
+
+            self._send(200, {
+                "id": f"chatcmpl-stub-{random.getrandbits(32):08x}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": request.get("model", "stub"),
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": json.dumps(STUB_RESPONSE)},
+                    "finish_reason": "stop"
+                }],
+                "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+            })
+
+    return StubHandler
+
+def start_stub_server(host="127.0.0.1", port=0, latency=1.0, error_rate=0.0):
+    """Start the stub on a background thread. Returns (server, base_url)."""
+    server = ThreadingHTTPServer((host, port), make_handler(latency, error_rate))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://{host}:{server.server_address[1]}/v1"
+    print(f"🧪 LLM stub server listening on {base_url}")
+    return server, base_url
+
+# -------------------- Benchmark --------------------
+if __name__ == "__main__":
+    os.environ.setdefault("OPENAI_API_KEY", "stub")
+    from parse_with_LLM import parse_many
+
+    n_requests = 32
+    server, base_url = start_stub_server(latency=1.0, error_rate=0.1)
+    texts = [f"stub statement {i}" for i in range(n_requests)]
+
+    try:
+        for concurrency in (1, 4, 16):
+            start = time.perf_counter()
+            results = parse_many(texts, concurrency=concurrency, rpm=6000, tpm=10_000_000,
+                                 use_cache=False, base_url=base_url)
+            elapsed = time.perf_counter() - start
+            ok = sum(1 for r in results if r)
+            print(f"⏱ concurrency={concurrency:>2}: {n_requests} requests in {elapsed:.1f}s "
+                  f"({n_requests / elapsed:.1f} req/s, {ok} parsed)")
+    finally:
+        server.shutdown()
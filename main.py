@@ -3,15 +3,25 @@ import json
 import cv2
 import unicodedata
 import re
-import tempfile
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor, as_completed
 from dotenv import load_dotenv
-from preprocess import preprocess_document
+from preprocess import PreprocessGraph
 from extract_ocr import extract_text_ocr
-from extract_pdf import extract_text_pdf, extract_text_pdf_with_preprocessing
+from extract_pdf import extract_text_pdf, extract_text_pdf_with_preprocessing, extract_text_pdf_hybrid
+from bank_templates import parse_with_template, find_template
+from layout_index import route_page, learn_layout, DEFAULT_LAYOUT_SETTINGS
+from output_writer import StreamingOutput, finalize_outputs, compact_outputs
+from manifest import Manifest
 from parse_with_LLM import (
     parse_structured_data,
     postprocess_task3,
-    export_table_to_excel_openpyxl
+    print_llm_cache_summary,
+    AsyncLLMDispatcher,
+    LLM_CONCURRENCY,
+    split_statement,
+    merge_chunk_results,
+    parse_many
 )
 
 # Load .env properly
@@ -23,58 +33,110 @@ def ensure_api_key():
         raise EnvironmentError("❌ OPENAI_API_KEY is not set.")
     os.environ["OPENAI_API_KEY"] = api_key
 
+# Set GMI_DEBUG_DIR to dump corrected page images while debugging
+DEBUG_DIR = os.getenv("GMI_DEBUG_DIR")
+# Text sent to GPT: "spaces" (space-padded lines), "tsv" or "grid" (detected table cells)
+TEXT_LAYOUT = os.getenv("GMI_TEXT_LAYOUT", "spaces")
+# Set GMI_LAYOUT_INDEX_ENABLED=0 to skip layout fingerprinting and always use the default settings
+USE_LAYOUT_INDEX = os.getenv("GMI_LAYOUT_INDEX_ENABLED", "1") != "0"
+
 def slugify_filename(filename):
     nfkd = unicodedata.normalize('NFKD', filename)
     ascii_str = nfkd.encode('ASCII', 'ignore').decode('utf-8')
     return re.sub(r'[^\w\-. ]', '', ascii_str)
 
-def process_file(input_path, add_spaces=True, lang='en', use_enhanced_pdf=True):
-    """Extract text and parse JSON for a single file, return (text, parsed_json)."""
+def ocr_image_with_layout(graph, input_path, add_spaces, lang, layout, use_layout_index=USE_LAYOUT_INDEX):
+    """Deskew + OCR one page (a PreprocessGraph) with the settings remembered for its layout.
+    Returns (graph, text, settings); the returned graph holds the angle and deskewed arrays used."""
+    layout_id = fingerprint = None
+    settings = json.loads(json.dumps(DEFAULT_LAYOUT_SETTINGS))
+    if use_layout_index:
+        layout_id, settings, fingerprint = route_page(graph.gray, lang)
+
+    preprocess = settings["preprocess"]
+    graph = graph.with_search(preprocess["delta"], preprocess["limit"])
+    default_limit = DEFAULT_LAYOUT_SETTINGS["preprocess"]["limit"]
+    if preprocess["limit"] < default_limit and abs(graph.angle) >= preprocess["limit"] - preprocess["delta"]:
+        # The skew ran into the layout's narrowed window, search the full range instead
+        graph = graph.with_search(preprocess["delta"], default_limit)
+
+    # OCR straight from the deskewed gray stage, no temporary JPEG
+    ocr = settings["ocr"]
+    extracted_text = extract_text_ocr(graph.deskewed_gray, add_spaces=add_spaces, max_tokens=None, lang=lang,
+                                      min_conf=ocr["min_conf"], layout=layout, config=ocr["config"])
+
+    if use_layout_index:
+        template = find_template(extracted_text, input_path, settings.get("parser"))
+        learn_layout(layout_id, settings, fingerprint, skew_angle=graph.angle, parser=template.name if template else None)
+    return graph, extracted_text, settings
+
+def extract_file_text(input_path, add_spaces=True, lang='en', use_enhanced_pdf=True, page_workers=None,
+                      debug_dir=DEBUG_DIR, use_hybrid_pdf=True, layout=TEXT_LAYOUT, return_layout=False, strict=False):
+    """Run preprocessing + OCR (or PDF text extraction) for a single file, return the text.
+    With use_enhanced_pdf + use_hybrid_pdf, PDF pages with a clean text layer skip OCR.
+    Corrected images are only written to disk when debug_dir is set.
+    With return_layout, return (text, layout_settings); layout settings are only known for images.
+    With strict, unreadable files and failed PDF pages raise instead of giving "" or partial text."""
     file_ext = os.path.splitext(input_path)[1].lower()
-    base_name = os.path.splitext(os.path.basename(input_path))[0]
-    clean_name = slugify_filename(base_name)
 
     extracted_text = ""
+    settings = None
 
-    # STEP 1: Extract text
     if file_ext in [".jpg", ".jpeg", ".png"]:
         print("🖼 Image detected. Running preprocessing + OCR...")
-        image = cv2.imread(input_path)
-        if image is None:
+        graph = PreprocessGraph(input_path)
+        try:
+            graph.decoded
+        except ValueError:
             print(f"❌ Failed to read image: {input_path}")
-            return "", None
+            if strict:
+                raise
+            return ("", None) if return_layout else ""
 
-        angle, corrected_image = preprocess_document(image)
-        print(f"✅ Skew corrected. Angle: {angle:.2f}°")
+        graph, extracted_text, settings = ocr_image_with_layout(graph, input_path, add_spaces, lang, layout)
+        print(f"✅ Skew corrected. Angle: {graph.angle:.2f}°")
 
-        # Save corrected image temporarily for OCR
-        with tempfile.NamedTemporaryFile(suffix=".jpg", delete=False) as tmpfile:
-            cv2.imwrite(tmpfile.name, corrected_image)
-            extracted_text = extract_text_ocr(tmpfile.name, add_spaces=add_spaces, max_tokens=16000, lang=lang)
+        if debug_dir:
+            os.makedirs(debug_dir, exist_ok=True)
+            corrected_path = os.path.join(debug_dir, f"corrected_{slugify_filename(os.path.basename(input_path))}")
+            cv2.imwrite(corrected_path, graph.deskewed)
+            print(f"📷 Corrected image saved: {corrected_path}")
 
     elif file_ext == ".pdf":
-        if use_enhanced_pdf:
+        if use_enhanced_pdf and use_hybrid_pdf:
+            print("📄 PDF detected. Using the text layer where usable, OCR for the remaining pages...")
+            extracted_text = extract_text_pdf_hybrid(
+                input_path,
+                debug_dir,
+                max_page_count=None,
+                max_tokens=None,
+                lang=lang,
+                page_workers=page_workers,
+                layout=layout,
+                strict=strict
+            )
+        elif use_enhanced_pdf:
             print("📄 PDF detected. Converting all pages to images and processing with OCR...")
             extracted_text = extract_text_pdf_with_preprocessing(
                 input_path, 
-                None, 
+                debug_dir, 
                 max_page_count=None,  
-                max_tokens=16000, 
-                lang=lang
+                max_tokens=None, 
+                lang=lang,
+                page_workers=page_workers,
+                layout=layout,
+                strict=strict
             )
         else:
             print("📄 PDF detected. Using standard PDF text extraction...")
-            extracted_text = extract_text_pdf(input_path, multiple_pages=True, max_page_count=3, max_tokens=16000, lang=lang)
+            extracted_text = extract_text_pdf(input_path, multiple_pages=True, max_page_count=3, max_tokens=None, lang=lang, layout=layout, strict=strict)
     else:
         print(f"❌ Unsupported file type: {file_ext}")
-        return "", None
 
-    if not extracted_text.strip():
-        print("⚠ No text extracted. Skipping file.")
-        return "", None
+    return (extracted_text, settings) if return_layout else extracted_text
 
-    # STEP 2: GPT Parsing
-    enhanced_prompt = f"""
+def build_enhanced_prompt(extracted_text):
+    return f"""
 You are an expert at extracting structured data from bank statements.
 
 Cleaned Bank Statement Text:
@@ -89,14 +151,149 @@ Extract the following information and return it as a JSON object:
 - closing_balance
 - transactions: list of transactions with date, description, amount, balance, transaction_type
 """
+
+def build_chunk_prompts(extracted_text):
+    """One prompt per token window of the statement (a single prompt for short documents)."""
+    return [build_enhanced_prompt(chunk) for chunk in split_statement(extracted_text)]
+
+def parse_extracted_text(extracted_text, input_path=None, template_name=None):
+    """Parse with the bank's template when it checks out, otherwise send the text to GPT.
+    Clean the result, return parsed_json or None.
+    Long statements are parsed chunk by chunk and merged so no page is dropped."""
+    try:
+        parsed_json = parse_with_template(extracted_text, input_path, template_name=template_name)
+        if parsed_json is not None:
+            return postprocess_task3(parsed_json)
+        prompts = build_chunk_prompts(extracted_text)
+        if len(prompts) == 1:
+            parsed_json = parse_structured_data(prompts[0])
+        else:
+            print(f"🧩 Parsing long statement in {len(prompts)} chunks...")
+            parsed_json = merge_chunk_results(parse_many(prompts))
+        return postprocess_task3(parsed_json)
+    except Exception as e:
+        print(f"❌ GPT parsing failed: {e}")
+        return None
+
+def process_file(input_path, add_spaces=True, lang='en', use_enhanced_pdf=True, page_workers=None):
+    """Extract text and parse JSON for a single file, return (text, parsed_json)."""
+    # STEP 1: Extract text
+    extracted_text, settings = extract_file_text(
+        input_path, add_spaces=add_spaces, lang=lang,
+        use_enhanced_pdf=use_enhanced_pdf, page_workers=page_workers, return_layout=True
+    )
+
+    if not extracted_text.strip():
+        print("⚠ No text extracted. Skipping file.")
+        return "", None
+
+    # STEP 2: GPT Parsing
+    return extracted_text, parse_extracted_text(extracted_text, input_path, (settings or {}).get("parser"))
+
+
+# -------------------- Batch Driver --------------------
+DEFAULT_WORKERS = int(os.getenv("GMI_WORKERS", os.cpu_count() or 1))
+# Skip inputs that an earlier run already processed unchanged (GMI_RESUME=0 starts over)
+RESUME = os.getenv("GMI_RESUME", "1") != "0"
+MANIFEST_NAME = "manifest.sqlite3"
+
+def collect_dataset_files(dataset_dir):
+    """Walk the dataset folder and return supported files in a stable, sorted order."""
+    all_files = []
+    for root, _, files in os.walk(dataset_dir):
+        for file in files:
+            if file.lower().endswith((".pdf", ".jpg", ".jpeg", ".png")):
+                all_files.append(os.path.join(root, file))
+    return sorted(all_files)
+
+def _extract_or_log(file_path, add_spaces, lang, use_enhanced_pdf):
+    """(text, layout_settings) for one file, (None, None) when extraction fails
+    so the failure is not mistaken for a blank document."""
     try:
-        parsed_json = parse_structured_data(enhanced_prompt)
-        parsed_json = postprocess_task3(parsed_json)
+        return extract_file_text(file_path, add_spaces, lang, use_enhanced_pdf, return_layout=True, strict=True)
+    except Exception as e:
+        print(f"❌ Failed to process {file_path}: {e}")
+        return None, None
+
+def _finish_parse(future):
+    """Postprocess a finished LLM future, return parsed_json or None."""
+    if future is None:
+        return None
+    try:
+        return postprocess_task3(future.result())
     except Exception as e:
         print(f"❌ GPT parsing failed: {e}")
-        return extracted_text, None
+        return None
+
+def run_batch(all_files, workers=None, llm_concurrency=None, add_spaces=True, lang='en', use_enhanced_pdf=True):
+    """
+    Preprocess + OCR files on a process pool while up to llm_concurrency GPT requests
+    run on an asyncio dispatcher. Results complete out of order but are yielded in
+    input order as (index, file_path, extracted_text, parsed_json); extracted_text is None
+    when extraction failed.
+    """
+    workers = max(1, workers or DEFAULT_WORKERS)
+    llm_concurrency = max(1, llm_concurrency or LLM_CONCURRENCY)
+    total = len(all_files)
+    print(f"⚙️ Running batch with {workers} OCR worker(s) and {llm_concurrency} concurrent LLM request(s).")
 
-    return extracted_text, parsed_json
+    texts = {}
+    parses = {}
+    next_index = 0
+
+    def ocr_done(i, extracted_text, settings=None):
+        texts[i] = extracted_text
+        if extracted_text is None:
+            parses[i] = None
+            return
+        if not extracted_text.strip():
+            print(f"⚠ No text extracted from {all_files[i]}. Skipping file.")
+            parses[i] = None
+            return
+        parsed_json = parse_with_template(extracted_text, all_files[i], template_name=(settings or {}).get("parser"))
+        if parsed_json is not None:
+            # Template hit: no GPT round trip, hand back an already completed future
+            parses[i] = Future()
+            parses[i].set_result(parsed_json)
+        else:
+            parses[i] = dispatcher.submit_chunks(build_chunk_prompts(extracted_text))
+
+    def release(block=False):
+        # Release results in input order so combined outputs stay deterministic
+        nonlocal next_index
+        while next_index in parses:
+            future = parses[next_index]
+            if future is not None and not future.done() and not block:
+                break
+            del parses[next_index]
+            yield (next_index, all_files[next_index], texts.pop(next_index), _finish_parse(future))
+            next_index += 1
+
+    with AsyncLLMDispatcher(concurrency=llm_concurrency) as dispatcher:
+        if workers == 1:
+            for i, file_path in enumerate(all_files):
+                print(f"\n🔄 Processing file {i + 1}/{total}: {file_path}")
+                ocr_done(i, *_extract_or_log(file_path, add_spaces, lang, use_enhanced_pdf))
+                yield from release()
+        else:
+            # The dispatcher's event-loop thread is already running: spawn workers instead of forking
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+                futures = {
+                    pool.submit(_extract_or_log, file_path, add_spaces, lang, use_enhanced_pdf): i
+                    for i, file_path in enumerate(all_files)
+                }
+                for done, future in enumerate(as_completed(futures), 1):
+                    i = futures[future]
+                    print(f"\n🔄 OCR finished {done}/{total}: {all_files[i]}")
+                    try:
+                        extracted_text, settings = future.result()
+                    except Exception as e:
+                        print(f"❌ Failed to process {all_files[i]}: {e}")
+                        extracted_text, settings = None, None
+                    ocr_done(i, extracted_text, settings)
+                    yield from release()
+
+        yield from release(block=True)
 
 
 # -------------------- Run Script --------------------
@@ -107,71 +304,31 @@ if __name__ == "__main__":
     output_dir = r"C:\Users\vikas\OneDrive\Desktop\GMI-TASK\output\dataset_output"
     os.makedirs(output_dir, exist_ok=True)
 
-    all_files = []
-    for root, _, files in os.walk(dataset_dir):
-        for file in files:
-            if file.lower().endswith((".pdf", ".jpg", ".jpeg", ".png")):
-                all_files.append(os.path.join(root, file))
+    all_files = collect_dataset_files(dataset_dir)
 
     if not all_files:
         print("❌ No PDF or image files found in dataset folder.")
     else:
         print(f"📂 Found {len(all_files)} files across all subfolders.")
 
-        combined_text = ""
-        combined_json = {"documents": []}
-        combined_transactions = {
-            "columns": ["File", "Date", "Description", "Amount", "Balance"],
-            "rows": []
-        }
-
-        for i, file_path in enumerate(all_files, 1):
-            print(f"\n🔄 Processing file {i}/{len(all_files)}: {file_path}")
-            try:
-                extracted_text, parsed_json = process_file(file_path)
-
-                if extracted_text:
-                    combined_text += f"\n\n===== {os.path.basename(file_path)} =====\n\n"
-                    combined_text += extracted_text
-
-                if parsed_json:
-                    combined_json["documents"].append({
-                        "file": os.path.basename(file_path),
-                        "data": parsed_json
-                    })
-
-                    for txn in parsed_json.get("transactions", []):
-                        combined_transactions["rows"].append([
-                            os.path.basename(file_path),
-                            txn.get("date", ""),
-                            txn.get("description", ""),
-                            txn.get("amount", ""),
-                            txn.get("balance", "")
-                        ])
-
-                print(f"✅ File {i}/{len(all_files)} added to combined output.")
-            except Exception as e:
-                print(f"❌ Failed to process {file_path}: {e}")
-                continue
-
-        # Save ONE TXT
-        txt_path = os.path.join(output_dir, "combined_output.txt")
-        with open(txt_path, "w", encoding="utf-8") as f:
-            f.write(combined_text)
-        print(f"📝 Combined TXT saved to: {txt_path}")
-
-        # Save ONE JSON
-        json_path = os.path.join(output_dir, "combined_output.json")
-        with open(json_path, "w", encoding="utf-8") as f:
-            json.dump(combined_json, f, indent=4, ensure_ascii=False)
-        print(f"📝 Combined JSON saved to: {json_path}")
-
-        # Save ONE Excel
-        excel_path = os.path.join(output_dir, "combined_output.xlsx")
-        try:
-            export_table_to_excel_openpyxl(combined_transactions, excel_path)
-            print(f"📊 Combined Excel saved to: {excel_path}")
-        except Exception as e:
-            print(f"❌ Excel export failed: {e}")
+        manifest = Manifest(os.path.join(output_dir, MANIFEST_NAME))
+        if not RESUME:
+            manifest.clear()
+        # Fingerprints are taken now, before any file is read for OCR
+        _, current, fingerprints = manifest.split(all_files)
+        # Keep earlier results only for unchanged files whose record is still in the stream
+        kept = compact_outputs(output_dir, current)
+        pending = [f for f in all_files if os.path.abspath(f) not in kept]
+        print(f"⏭ {len(kept)} unchanged files already processed, {len(pending)} to process.")
+
+        # Each document is appended to the TXT/NDJSON stream as soon as it is done
+        with StreamingOutput(output_dir, append=True, manifest=manifest) as output:
+            for i, file_path, extracted_text, parsed_json in run_batch(pending, workers=DEFAULT_WORKERS, llm_concurrency=LLM_CONCURRENCY):
+                output.write(file_path, extracted_text, parsed_json, fingerprints[file_path])
+                print(f"✅ File {i + 1}/{len(pending)} added to combined output.")
+
+        # Stream sorted back into dataset order, then pretty JSON and Excel rebuilt from it
+        finalize_outputs(output_dir)
 
+        print_llm_cache_summary()
         print(f"\n🎉 Finished processing {len(all_files)} files into ONE JSON, ONE Excel, ONE TXT.")
\ No newline at end of file
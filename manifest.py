@@ -0,0 +1,81 @@
+import os
+import time
+import hashlib
+from cache import sqlite_connect
+
+# ----- Manifest Settings -----
+# Bump when extraction, parsing or the output format changes so every input is reprocessed once
+PIPELINE_VERSION = os.getenv("GMI_PIPELINE_VERSION", "1")
+# Statuses that count as done. "failed" (no parse) and "error" (extraction raised) are retried
+DONE_STATUSES = ("parsed", "empty")
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+# ----- Processing Manifest -----
+class Manifest:
+    """
+    One row per input file in a SQLite file: content hash, size, mtime, pipeline version,
+    output location and status. An input is current when its last run finished under the
+    same pipeline version and its content is unchanged. Size and mtime are checked first,
+    so only files that look touched are re-hashed.
+    """
+
+    def __init__(self, path, version=PIPELINE_VERSION):
+        self.path = path
+        self.version = version
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with sqlite_connect(self.path) as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS files ("
+                "path TEXT PRIMARY KEY, sha256 TEXT NOT NULL, size INTEGER NOT NULL, mtime REAL NOT NULL, "
+                "version TEXT NOT NULL, output TEXT, status TEXT NOT NULL, processed REAL NOT NULL)"
+            )
+
+    def check(self, path):
+        """(is_current, fingerprint) for path. is_current means it was processed by this pipeline
+        version and has not changed since. The fingerprint is the one to record once path is
+        processed: stored values when size and mtime still match, else freshly hashed."""
+        key = os.path.abspath(path)
+        with sqlite_connect(self.path) as conn:
+            row = conn.execute(
+                "SELECT sha256, size, mtime, version, status FROM files WHERE path = ?", (key,)
+            ).fetchone()
+        stat = os.stat(path)
+        if row is not None and stat.st_size == row[1] and stat.st_mtime == row[2]:
+            fingerprint = (row[0], row[1], row[2])
+        else:
+            fingerprint = (file_sha256(path), stat.st_size, stat.st_mtime)
+        if row is None or row[3] != self.version or row[4] not in DONE_STATUSES or fingerprint[0] != row[0]:
+            return False, fingerprint
+        if fingerprint[2] != row[2]:
+            # Touched but identical: remember the new mtime so the next run skips the hash
+            with sqlite_connect(self.path) as conn:
+                conn.execute("UPDATE files SET mtime = ? WHERE path = ?", (fingerprint[2], key))
+        return True, fingerprint
+
+    def record_many(self, entries):
+        """Store (path, fingerprint, output, status) results, with the fingerprint taken before
+        the file was read. Call only once their outputs are on disk."""
+        rows = [(os.path.abspath(path), sha256, size, mtime, self.version, output, status, time.time())
+                for path, (sha256, size, mtime), output, status in entries]
+        if rows:
+            with sqlite_connect(self.path) as conn:
+                conn.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def split(self, paths):
+        """(pending, current, fingerprints): paths to process and paths already done, in their
+        original order, and the fingerprint of every path to pass on to the output writer."""
+        pending, current, fingerprints = [], [], {}
+        for path in paths:
+            is_current, fingerprints[path] = self.check(path)
+            (current if is_current else pending).append(path)
+        return pending, current, fingerprints
+
+    def clear(self):
+        with sqlite_connect(self.path) as conn:
+            conn.execute("DELETE FROM files")
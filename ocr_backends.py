@@ -0,0 +1,167 @@
+import os
+import time
+import queue
+import shlex
+import threading
+import pytesseract
+import numpy as np
+from PIL import Image
+from contextlib import contextmanager
+
+try:
+    import tesserocr
+except ImportError:  # optional: pip install tesserocr
+    tesserocr = None
+
+# ----- Backend Settings -----
+# "auto" uses warm tesserocr engines when the bindings are installed, else the pytesseract CLI
+OCR_BACKEND = os.getenv("GMI_OCR_BACKEND", "auto")  # "auto", "tesserocr" or "pytesseract"
+# Engines kept alive per (lang, config) in each process
+OCR_POOL_SIZE = int(os.getenv("GMI_OCR_POOL_SIZE", "2"))
+
+DATA_KEYS = ("text", "conf", "left", "top", "width", "height")
+
+def parse_tesseract_config(config):
+    """Split a pytesseract-style config string ("--psm 6 -c key=value") into (psm, variables)."""
+    psm = None
+    variables = {}
+    args = shlex.split(config or "")
+    for i, arg in enumerate(args):
+        if arg == "--psm" and i + 1 < len(args):
+            psm = int(args[i + 1])
+        elif arg == "-c" and i + 1 < len(args) and "=" in args[i + 1]:
+            name, value = args[i + 1].split("=", 1)
+            variables[name] = value
+    return psm, variables
+
+# ----- Backends -----
+class PytesseractBackend:
+    """One `tesseract` process per call: the image goes through a temp file and the
+    language models are reloaded every time."""
+
+    name = "pytesseract"
+
+    def image_to_data(self, image, lang="eng", config=""):
+        return pytesseract.image_to_data(image, lang=lang, config=config, output_type=pytesseract.Output.DICT)
+
+class TesserocrBackend:
+    """Tesseract C API engines that stay loaded between calls. Each (lang, config) gets a pool of up
+    to pool_size engines, created on first use; a call borrows one, so threads never share an engine."""
+
+    name = "tesserocr"
+
+    def __init__(self, pool_size=OCR_POOL_SIZE, tessdata=None):
+        if tesserocr is None:
+            raise ImportError("tesserocr is not installed")
+        self.pool_size = max(1, pool_size)
+        self.tessdata = tessdata or os.getenv("TESSDATA_PREFIX")
+        self._pools = {}
+        self._created = {}
+        self._lock = threading.Lock()
+
+    def _new_engine(self, lang, config):
+        kwargs = {"lang": lang}
+        if self.tessdata and os.path.isdir(self.tessdata):
+            kwargs["path"] = self.tessdata
+        api = tesserocr.PyTessBaseAPI(**kwargs)
+        psm, variables = parse_tesseract_config(config)
+        if psm is not None:
+            api.SetPageSegMode(psm)
+        for name, value in variables.items():
+            api.SetVariable(name, value)
+        return api
+
+    @contextmanager
+    def _engine(self, lang, config):
+        key = (lang, config)
+        with self._lock:
+            pool = self._pools.setdefault(key, queue.Queue())
+            create = pool.empty() and self._created.get(key, 0) < self.pool_size
+            if create:
+                self._created[key] = self._created.get(key, 0) + 1
+        if create:
+            try:
+                api = self._new_engine(lang, config)
+            except Exception:
+                with self._lock:
+                    self._created[key] -= 1
+                raise
+        else:
+            api = pool.get()
+        try:
+            yield api
+        finally:
+            api.Clear()
+            pool.put(api)
+
+    def image_to_data(self, image, lang="eng", config=""):
+        """Word boxes in the same dict-of-lists shape as pytesseract.image_to_data."""
+        if isinstance(image, np.ndarray):
+            image = Image.fromarray(image)
+        data = {key: [] for key in DATA_KEYS}
+        with self._engine(lang, config) as api:
+            api.SetImage(image)
+            api.Recognize()
+            iterator = api.GetIterator()
+            level = tesserocr.RIL.WORD
+            for word in tesserocr.iterate_level(iterator, level):
+                text = word.GetUTF8Text(level)
+                box = word.BoundingBox(level)
+                if not text or box is None:
+                    continue
+                x1, y1, x2, y2 = box
+                data["text"].append(text)
+                data["conf"].append(int(word.Confidence(level)))
+                data["left"].append(x1)
+                data["top"].append(y1)
+                data["width"].append(x2 - x1)
+                data["height"].append(y2 - y1)
+        return data
+
+    def close(self):
+        with self._lock:
+            for pool in self._pools.values():
+                while not pool.empty():
+                    pool.get().End()
+            self._pools.clear()
+            self._created.clear()
+
+_backends = {}
+
+def get_ocr_backend(name=None):
+    """Backend by name ("auto", "tesserocr", "pytesseract"), one instance per process."""
+    name = name or OCR_BACKEND
+    if name == "auto":
+        name = "tesserocr" if tesserocr is not None else "pytesseract"
+    if name not in _backends:
+        if name == "tesserocr":
+            _backends[name] = TesserocrBackend()
+        elif name == "pytesseract":
+            _backends[name] = PytesseractBackend()
+        else:
+            raise ValueError(f"Unknown OCR backend: {name}")
+    return _backends[name]
+
+# ----- Benchmark -----
+def benchmark_backends(image, lang="eng", repeat=5):
+    """Time repeated OCR of one page with every available backend. The first tesserocr call
+    includes loading the engine, so it is reported separately."""
+    names = ["pytesseract"] + (["tesserocr"] if tesserocr is not None else [])
+    if tesserocr is None:
+        print("ℹ️ tesserocr not installed, benchmarking pytesseract only.")
+    for name in names:
+        backend = get_ocr_backend(name)
+        start = time.perf_counter()
+        data = backend.image_to_data(image, lang=lang)
+        first = time.perf_counter() - start
+        start = time.perf_counter()
+        for _ in range(repeat):
+            backend.image_to_data(image, lang=lang)
+        warm = (time.perf_counter() - start) / repeat
+        print(f"⏱ {name:<12} first call {first:.2f}s, then {warm:.2f}s per page ({len(data['text'])} boxes)")
+
+if __name__ == "__main__":
+    # Importing extract_ocr sets the Tesseract paths
+    import extract_ocr
+    input_path = r"gmindia-challlenge-012024-datas\creditMutuel\AOUT 2021.pdf4.jpg"
+    benchmark_backends(Image.open(input_path))
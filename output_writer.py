@@ -0,0 +1,177 @@
+import os
+import json
+import textwrap
+from parse_with_LLM import export_rows_to_excel_streaming
+
+# ----- Output Settings -----
+# Documents between fsync checkpoints; every document is still flushed as soon as it is written
+FSYNC_EVERY = int(os.getenv("GMI_FSYNC_EVERY", "10"))
+
+TXT_NAME = "combined_output.txt"
+NDJSON_NAME = "combined_output.ndjson"
+JSON_NAME = "combined_output.json"
+XLSX_NAME = "combined_output.xlsx"
+TRANSACTION_COLUMNS = ["File", "Date", "Description", "Amount", "Balance"]
+
+def _write_txt_block(f, file_path, extracted_text):
+    if extracted_text:
+        f.write(f"\n\n===== {os.path.basename(file_path)} =====\n\n")
+        f.write(extracted_text)
+
+# ----- Streaming Writer -----
+class StreamingOutput:
+    """
+    Appends each finished document to the combined outputs as it arrives: its text block to
+    combined_output.txt and one {"file", "path", "text", "data"} line to combined_output.ndjson.
+    A crash loses at most the documents since the last fsync checkpoint, and memory no
+    longer grows with the dataset. Pretty JSON and XLSX are built afterwards by finalize_outputs.
+    With a manifest, documents are recorded only once a checkpoint has put them on disk.
+    extracted_text None means extraction itself failed, recorded as "error" so it is retried.
+    """
+
+    def __init__(self, output_dir, fsync_every=FSYNC_EVERY, append=False, manifest=None):
+        os.makedirs(output_dir, exist_ok=True)
+        self.output_dir = output_dir
+        self.fsync_every = max(1, fsync_every)
+        mode = "a" if append else "w"
+        self._txt = open(os.path.join(output_dir, TXT_NAME), mode, encoding="utf-8")
+        self._ndjson = open(os.path.join(output_dir, NDJSON_NAME), mode, encoding="utf-8")
+        self._pending = 0
+        self.manifest = manifest
+        self._unrecorded = []
+
+    def write(self, file_path, extracted_text, parsed_json, fingerprint=None):
+        _write_txt_block(self._txt, file_path, extracted_text)
+        record = {"file": os.path.basename(file_path), "path": file_path, "text": extracted_text, "data": parsed_json}
+        self._ndjson.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._txt.flush()
+        self._ndjson.flush()
+        if self.manifest is not None and fingerprint is not None:
+            if extracted_text is None:
+                status = "error"
+            elif parsed_json:
+                status = "parsed"
+            else:
+                status = "failed" if extracted_text.strip() else "empty"
+            self._unrecorded.append((file_path, fingerprint, self._ndjson.name, status))
+
+        self._pending += 1
+        if self._pending >= self.fsync_every:
+            self.checkpoint()
+
+    def checkpoint(self):
+        """Force everything written so far onto disk."""
+        for f in (self._txt, self._ndjson):
+            f.flush()
+            os.fsync(f.fileno())
+        self._pending = 0
+        if self._unrecorded:
+            self.manifest.record_many(self._unrecorded)
+            self._unrecorded = []
+
+    def close(self):
+        if not self._txt.closed:
+            self.checkpoint()
+            self._txt.close()
+            self._ndjson.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# ----- Finalization -----
+def _iter_records(ndjson_path):
+    """(byte offset, record) for each line of an NDJSON stream. A line cut short by a crash is skipped."""
+    if not os.path.exists(ndjson_path):
+        return
+    with open(ndjson_path, "rb") as f:
+        offset = 0
+        for line_number, line in enumerate(f, 1):
+            start, offset = offset, offset + len(line)
+            if not line.strip():
+                continue
+            try:
+                yield start, json.loads(line)
+            except ValueError:
+                print(f"⚠️ Skipping unreadable line {line_number} in {ndjson_path}")
+
+def iter_documents(output_dir):
+    """Records of the NDJSON stream in order."""
+    for _, record in _iter_records(os.path.join(output_dir, NDJSON_NAME)):
+        yield record
+
+def compact_outputs(output_dir, keep_paths=None):
+    """
+    Rewrite the TXT/NDJSON stream with the latest record of each path, sorted by path (the
+    order collect_dataset_files returns), so the outputs do not depend on which run produced
+    which document. With keep_paths, records of other paths are dropped: a resumed run keeps
+    the unchanged files and appends the ones it reprocesses. Only byte offsets are held in
+    memory, not the records. Returns the set of (absolute) paths kept.
+    """
+    keep_paths = None if keep_paths is None else {os.path.abspath(p) for p in keep_paths}
+    txt_path = os.path.join(output_dir, TXT_NAME)
+    ndjson_path = os.path.join(output_dir, NDJSON_NAME)
+
+    latest = {}
+    for offset, record in _iter_records(ndjson_path):
+        path = record.get("path") or ""
+        if keep_paths is None or os.path.abspath(path) in keep_paths:
+            latest[path] = offset
+
+    with open(txt_path + ".tmp", "w", encoding="utf-8") as txt, open(ndjson_path + ".tmp", "w", encoding="utf-8") as ndjson:
+        if latest:
+            with open(ndjson_path, "rb") as src:
+                for path in sorted(latest):
+                    src.seek(latest[path])
+                    record = json.loads(src.readline())
+                    _write_txt_block(txt, path, record.get("text"))
+                    ndjson.write(json.dumps(record, ensure_ascii=False) + "\n")
+        for f in (txt, ndjson):
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(txt_path + ".tmp", txt_path)
+    os.replace(ndjson_path + ".tmp", ndjson_path)
+    return {os.path.abspath(path) for path in latest}
+
+def iter_transaction_rows(output_dir):
+    for record in iter_documents(output_dir):
+        for txn in (record["data"] or {}).get("transactions", []):
+            yield [
+                record["file"],
+                txn.get("date", ""),
+                txn.get("description", ""),
+                txn.get("amount", ""),
+                txn.get("balance", "")
+            ]
+
+def write_pretty_json(output_dir):
+    """combined_output.json ({"documents": [{"file", "data"}, ...]}, indent 4) written document by document."""
+    json_path = os.path.join(output_dir, JSON_NAME)
+    with open(json_path, "w", encoding="utf-8") as f:
+        first = True
+        for record in iter_documents(output_dir):
+            if not record["data"]:
+                continue
+            document = {"file": record["file"], "data": record["data"]}
+            f.write('{\n    "documents": [\n' if first else ",\n")
+            f.write(textwrap.indent(json.dumps(document, indent=4, ensure_ascii=False), " " * 8))
+            first = False
+        f.write('{\n    "documents": []\n}' if first else "\n    ]\n}")
+    return json_path
+
+def finalize_outputs(output_dir):
+    """Sort the TXT/NDJSON stream by path, then build the pretty JSON and the Excel sheet from it."""
+    compact_outputs(output_dir)
+    print(f"📝 Combined TXT saved to: {os.path.join(output_dir, TXT_NAME)}")
+
+    json_path = write_pretty_json(output_dir)
+    print(f"📝 Combined JSON saved to: {json_path}")
+
+    excel_path = os.path.join(output_dir, XLSX_NAME)
+    try:
+        export_rows_to_excel_streaming(TRANSACTION_COLUMNS, lambda: iter_transaction_rows(output_dir), excel_path)
+        print(f"📊 Combined Excel saved to: {excel_path}")
+    except Exception as e:
+        print(f"❌ Excel export failed: {e}")
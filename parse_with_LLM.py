@@ -1,10 +1,21 @@
 import os
 import json
+import time
+import random
+import asyncio
+import threading
 from datetime import datetime
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import (
+    OpenAI, AsyncOpenAI,
+    APIConnectionError, APIStatusError, APITimeoutError, RateLimitError
+)
 from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
 from openpyxl.styles import Font, Alignment
+from openpyxl.utils import get_column_letter
+from extract_ocr import split_tokens, num_tokens, format_table, is_table_header, is_grid_line, PAGE_BREAK
+from cache import CACHE_DIR, CACHE_ENABLED, FileCache, SQLiteCache, make_key
 
 load_dotenv()
 
@@ -51,17 +62,56 @@ def is_valid_amount(value):
         return False
 
 # -----------------------
-# Main Parsing Function
+# LLM Settings & Response Cache
 # -----------------------
 
-def parse_structured_data(input_text: str) -> dict:
-    """Send cleaned OCR text to LLM for structured parsing."""
-    api_key = os.getenv("OPENAI_API_KEY")
-    if not api_key:
-        raise ValueError("❌ OPENAI_API_KEY is not set")
+LLM_MODEL = "gpt-4o"
+LLM_TEMPERATURE = 0.0
+LLM_CACHE_BACKEND = os.getenv("GMI_LLM_CACHE_BACKEND", "sqlite")  # "sqlite", "file" or "off"
+LLM_CACHE_TTL = float(os.getenv("GMI_LLM_CACHE_TTL_DAYS", "30")) * 24 * 3600
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("GMI_LLM_CACHE_MAX_ENTRIES", "20000"))
+
+_client = None
+_llm_cache = None
 
-    client = OpenAI(api_key=api_key)
+def get_client():
+    """Build the OpenAI client once per process."""
+    global _client
+    if _client is None:
+        api_key = os.getenv("OPENAI_API_KEY")
+        if not api_key:
+            raise ValueError("❌ OPENAI_API_KEY is not set")
+        _client = OpenAI(api_key=api_key)
+    return _client
+
+def get_llm_cache():
+    """Return the configured response cache (SQLite or file backend)."""
+    global _llm_cache
+    if _llm_cache is None:
+        enabled = CACHE_ENABLED and LLM_CACHE_BACKEND != "off"
+        if LLM_CACHE_BACKEND == "file":
+            _llm_cache = FileCache(os.path.join(CACHE_DIR, "llm"), enabled=enabled, ttl=LLM_CACHE_TTL)
+        else:
+            _llm_cache = SQLiteCache(
+                os.path.join(CACHE_DIR, "llm.sqlite3"),
+                max_entries=LLM_CACHE_MAX_ENTRIES, enabled=enabled, ttl=LLM_CACHE_TTL
+            )
+    return _llm_cache
+
+def llm_cache_key(model, temperature, messages):
+    """Key a request by model, temperature and a hash of the full message list."""
+    payload = json.dumps(messages, ensure_ascii=False, sort_keys=True).encode("utf-8")
+    return make_key("llm", model, temperature, payload)
+
+def print_llm_cache_summary():
+    print(f"💾 {get_llm_cache().stats.summary('LLM cache')}")
+
+# -----------------------
+# Main Parsing Function
+# -----------------------
 
+def build_messages(input_text):
+    """Wrap cleaned OCR text in the structured-extraction prompt."""
     prompt = f"""
 You are an expert at extracting structured data from bank statements.
 
@@ -85,22 +135,323 @@ Extract the following information and return it as a JSON object:
 If any field is not found or unclear, use null. Don't make assumptions.
 Return only the JSON object:
 """
+    return [
+        {"role": "system", "content": "You are a financial statement parser."},
+        {"role": "user", "content": prompt}
+    ]
+
+def parse_structured_data(input_text: str, use_cache=True) -> dict:
+    """Send cleaned OCR text to LLM for structured parsing.
+    Responses are cached by model, temperature and message hash."""
+    messages = build_messages(input_text)
+    cache = get_llm_cache()
+    key = llm_cache_key(LLM_MODEL, LLM_TEMPERATURE, messages)
+
+    if use_cache:
+        cached = cache.get(key)
+        if cached is not None:
+            return json.loads(handle_json(cached))
+
+    client = get_client()
 
     try:
         result = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": "You are a financial statement parser."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.0,
+            model=LLM_MODEL,
+            messages=messages,
+            temperature=LLM_TEMPERATURE,
         )
         raw_response = result.choices[0].message.content
-        return json.loads(handle_json(raw_response))
+        parsed = json.loads(handle_json(raw_response))
+        if use_cache:
+            cache.set(key, raw_response)
+        return parsed
     except Exception as e:
         print("❌ Error parsing structured data:", e)
         return {}
 
+# -----------------------
+# Async Dispatch
+# -----------------------
+
+LLM_CONCURRENCY = int(os.getenv("GMI_LLM_CONCURRENCY", "8"))
+LLM_RPM = int(os.getenv("GMI_LLM_RPM", "500"))
+LLM_TPM = int(os.getenv("GMI_LLM_TPM", "30000"))
+LLM_TIMEOUT = float(os.getenv("GMI_LLM_TIMEOUT", "120"))
+LLM_MAX_RETRIES = int(os.getenv("GMI_LLM_MAX_RETRIES", "5"))
+LLM_BACKOFF_BASE = 1.0
+LLM_BACKOFF_MAX = 60.0
+# Completion budget reserved per request when charging the tokens-per-minute bucket
+LLM_EXPECTED_COMPLETION_TOKENS = 1500
+
+class TokenBucket:
+    """Async token bucket holding up to `per_minute` tokens, refilled continuously."""
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.tokens = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, amount=1):
+        amount = min(float(amount), self.capacity)
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+
+class RateLimiter:
+    """Requests-per-minute and tokens-per-minute buckets acquired together."""
+
+    def __init__(self, rpm=LLM_RPM, tpm=LLM_TPM):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+
+    async def acquire(self, token_count):
+        await self.requests.acquire(1)
+        await self.tokens.acquire(token_count)
+
+def estimate_request_tokens(messages):
+    """Rough token charge for a request: ~4 characters per prompt token plus the completion budget."""
+    prompt_chars = sum(len(m["content"]) for m in messages)
+    return prompt_chars // 4 + LLM_EXPECTED_COMPLETION_TOKENS
+
+def _retry_delay(error, attempt):
+    """Exponential backoff with jitter; honours Retry-After on 429 responses when present."""
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    if retry_after:
+        try:
+            return min(LLM_BACKOFF_MAX, float(retry_after))
+        except ValueError:
+            pass
+    delay = min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * (2 ** attempt))
+    return delay * (0.5 + random.random() / 2)
+
+def _is_retryable(error):
+    if isinstance(error, (asyncio.TimeoutError, APITimeoutError, APIConnectionError, RateLimitError)):
+        return True
+    return isinstance(error, APIStatusError) and error.status_code >= 500
+
+async def parse_structured_data_async(input_text, client, limiter, use_cache=True,
+                                      timeout=LLM_TIMEOUT, max_retries=LLM_MAX_RETRIES) -> dict:
+    """Async counterpart of parse_structured_data with rate limiting, timeouts and retries."""
+    messages = build_messages(input_text)
+    cache = get_llm_cache()
+    key = llm_cache_key(LLM_MODEL, LLM_TEMPERATURE, messages)
+
+    if use_cache:
+        cached = cache.get(key)
+        if cached is not None:
+            return json.loads(handle_json(cached))
+
+    token_count = estimate_request_tokens(messages)
+    for attempt in range(max_retries + 1):
+        await limiter.acquire(token_count)
+        try:
+            result = await asyncio.wait_for(
+                client.chat.completions.create(
+                    model=LLM_MODEL,
+                    messages=messages,
+                    temperature=LLM_TEMPERATURE,
+                ),
+                timeout,
+            )
+        except Exception as e:
+            if not _is_retryable(e) or attempt == max_retries:
+                print("❌ Error parsing structured data:", str(e) or type(e).__name__)
+                return {}
+            delay = _retry_delay(e, attempt)
+            print(f"⏳ LLM request failed ({type(e).__name__}), retry {attempt + 1}/{max_retries} in {delay:.1f}s")
+            await asyncio.sleep(delay)
+            continue
+
+        try:
+            raw_response = result.choices[0].message.content
+            parsed = json.loads(handle_json(raw_response))
+        except Exception as e:
+            print("❌ Error parsing structured data:", e)
+            return {}
+        if use_cache:
+            cache.set(key, raw_response)
+        return parsed
+    return {}
+
+def _async_client(base_url=None):
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        raise ValueError("❌ OPENAI_API_KEY is not set")
+    # Retries are handled by parse_structured_data_async so backoff honours the rate limiter
+    return AsyncOpenAI(api_key=api_key, base_url=base_url, max_retries=0)
+
+async def parse_many_async(texts, concurrency=LLM_CONCURRENCY, rpm=LLM_RPM, tpm=LLM_TPM,
+                           use_cache=True, base_url=None):
+    """Parse many texts with up to `concurrency` requests in flight; results keep input order."""
+    client = _async_client(base_url)
+    limiter = RateLimiter(rpm, tpm)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(text):
+        async with semaphore:
+            return await parse_structured_data_async(text, client, limiter, use_cache=use_cache)
+
+    try:
+        return await asyncio.gather(*(run(text) for text in texts))
+    finally:
+        await client.close()
+
+def parse_many(texts, **kwargs):
+    """Blocking wrapper around parse_many_async."""
+    return asyncio.run(parse_many_async(texts, **kwargs))
+
+class AsyncLLMDispatcher:
+    """
+    Runs an asyncio loop on a background thread so synchronous callers can keep
+    N LLM requests in flight. submit() returns a concurrent.futures.Future.
+    """
+
+    def __init__(self, concurrency=LLM_CONCURRENCY, rpm=LLM_RPM, tpm=LLM_TPM, use_cache=True, base_url=None):
+        self.use_cache = use_cache
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+        self._client = _async_client(base_url)
+
+        async def setup():
+            return RateLimiter(rpm, tpm), asyncio.Semaphore(concurrency)
+
+        self._limiter, self._semaphore = self._run(setup())
+
+    def _run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    async def _parse(self, text):
+        async with self._semaphore:
+            return await parse_structured_data_async(text, self._client, self._limiter, use_cache=self.use_cache)
+
+    def submit(self, text):
+        return asyncio.run_coroutine_threadsafe(self._parse(text), self._loop)
+
+    async def _parse_chunks(self, texts):
+        results = await asyncio.gather(*(self._parse(text) for text in texts))
+        return merge_chunk_results(results)
+
+    def submit_chunks(self, texts):
+        """Parse chunks of one statement concurrently; the future resolves to the merged result."""
+        if len(texts) == 1:
+            return self.submit(texts[0])
+        return asyncio.run_coroutine_threadsafe(self._parse_chunks(texts), self._loop)
+
+    def close(self):
+        self._run(self._client.close())
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# -----------------------
+# Chunked (Map-Reduce) Parsing
+# -----------------------
+
+# Input tokens per chunk, small enough that each chunk's JSON answer fits the completion limit
+LLM_CHUNK_TOKENS = int(os.getenv("GMI_LLM_CHUNK_TOKENS", "4000"))
+# Header fields taken from the first chunk that has them, and from the last one
+FIRST_CHUNK_FIELDS = ("account_number", "bank_name", "account_holder", "statement_period", "opening_balance")
+LAST_CHUNK_FIELDS = ("closing_balance",)
+
+def split_grid_line(line, chunk_tokens):
+    """Split one over-long grid page ({"columns", "rows"} JSON) into smaller grids that repeat
+    the columns, so no chunk ever holds half a JSON object."""
+    grid = json.loads(line)
+    columns, rows = grid.get("columns") or [], grid.get("rows") or []
+    budget = chunk_tokens - num_tokens(format_table(columns, [], "grid"))
+    parts, current, current_tokens = [], [], 0
+    for row in rows:
+        row_tokens = num_tokens(json.dumps(row, ensure_ascii=False)) + 1
+        if current and current_tokens + row_tokens > budget:
+            parts.append(format_table(columns, current, "grid"))
+            current, current_tokens = [], 0
+        current.append(row)
+        current_tokens += row_tokens
+    if current or not parts:
+        parts.append(format_table(columns, current, "grid"))
+    return parts
+
+def split_page(page, chunk_tokens):
+    """Line-aligned windows of one page too long for a chunk. Grid lines are split by rows,
+    and windows that start mid-table repeat the page's last TSV header line."""
+    lines = []
+    for line in page.splitlines():
+        if is_grid_line(line) and num_tokens(line) > chunk_tokens:
+            lines.extend(split_grid_line(line, chunk_tokens))
+        else:
+            lines.append(line)
+    headers = [line for line in lines if is_table_header(line)]
+    budget = chunk_tokens - (num_tokens(headers[-1]) + 1 if headers else 0)
+
+    chunks, header = [], None
+    for chunk in split_tokens("\n".join(lines), budget):
+        chunk_lines = chunk.splitlines()
+        if header and not (chunk_lines and is_table_header(chunk_lines[0])):
+            chunk = header + "\n" + chunk
+        header = next((line for line in reversed(chunk_lines) if is_table_header(line)), header)
+        chunks.append(chunk)
+    return chunks
+
+def split_statement(text, chunk_tokens=LLM_CHUNK_TOKENS):
+    """
+    Split statement text into chunks of whole pages (PAGE_BREAK separated) up to chunk_tokens
+    each; only a page that is too long on its own is split further, by split_page. Every chunk
+    is tagged with its part number.
+    """
+    if not text:
+        return [text]
+    chunks, current, current_tokens = [], [], 0
+    for page in text.split(PAGE_BREAK):
+        page = page.strip("\n")
+        if not page.strip():
+            continue
+        page_tokens = num_tokens(page)
+        if current and current_tokens + page_tokens > chunk_tokens:
+            chunks.append(f"\n{PAGE_BREAK}\n".join(current))
+            current, current_tokens = [], 0
+        if page_tokens > chunk_tokens:
+            chunks.extend(split_page(page, chunk_tokens))
+        else:
+            current.append(page)
+            current_tokens += page_tokens
+    if current:
+        chunks.append(f"\n{PAGE_BREAK}\n".join(current))
+    if len(chunks) <= 1:
+        return [text]
+    return [f"[Part {i} of {len(chunks)} of the statement]\n{chunk}" for i, chunk in enumerate(chunks, 1)]
+
+def merge_chunk_results(results):
+    """Reduce per-chunk parses into one document: header fields from the first/last chunk
+    that reports them, transactions concatenated in chunk order. If any chunk failed
+    (came back empty) the whole document is {} so it counts as failed instead of
+    silently missing that chunk's transactions."""
+    if not all(results):
+        print(f"❌ {sum(1 for r in results if not r)} of {len(results)} chunks failed, document not merged.")
+        return {}
+    merged = {}
+    for field in FIRST_CHUNK_FIELDS:
+        merged[field] = next((r.get(field) for r in results if r.get(field) is not None), None)
+    for field in LAST_CHUNK_FIELDS:
+        merged[field] = next((r.get(field) for r in reversed(results) if r.get(field) is not None), None)
+    merged["transactions"] = [txn for r in results for txn in (r.get("transactions") or [])]
+    return merged
+
 # -----------------------
 # Post-processing
 # -----------------------
@@ -146,3 +497,32 @@ def export_table_to_excel_openpyxl(table_data, output_path):
 
     wb.save(output_path)
     print(f"📁 Excel file saved to: {output_path}")
+
+def export_rows_to_excel_streaming(columns, iter_rows, output_path):
+    """
+    Same sheet as export_table_to_excel_openpyxl, built with a write-only workbook so rows
+    are never all held in memory. iter_rows() is called twice: once to size the columns,
+    once to write the rows.
+    """
+    widths = [len(str(c)) for c in columns]
+    for row in iter_rows():
+        for i, value in enumerate(row[:len(widths)]):
+            widths[i] = max(widths[i], len(str(value)) if value else 0)
+
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Transactions")
+    for i, width in enumerate(widths, 1):
+        ws.column_dimensions[get_column_letter(i)].width = width + 2
+
+    header = []
+    for col in columns:
+        cell = WriteOnlyCell(ws, value=col)
+        cell.font = Font(bold=True)
+        cell.alignment = Alignment(horizontal="center")
+        header.append(cell)
+    ws.append(header)
+
+    for row in iter_rows():
+        ws.append(row)
+
+    wb.save(output_path)
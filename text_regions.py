@@ -0,0 +1,67 @@
+import cv2
+import numpy as np
+
+# ----- Region Settings -----
+REGION_PAD = 8               # pixels kept around each region so edge glyphs are not clipped
+REGION_MIN_HEIGHT = 8        # components shorter than this are specks, not text
+REGION_MAX_COVERAGE = 0.8    # above this share of the page, OCR the full page instead
+DETECT_MAX_SIZE = 1600       # regions are found on a copy downscaled to this longest side
+
+def to_gray(image):
+    """Grayscale uint8 array from a PIL image or a BGR/grayscale array."""
+    array = np.asarray(image)
+    if array.ndim == 3:
+        code = cv2.COLOR_BGR2GRAY if array.shape[2] == 3 else cv2.COLOR_BGRA2GRAY
+        array = cv2.cvtColor(array, code)
+    return array
+
+def merge_boxes(boxes):
+    """Merge overlapping (x1, y1, x2, y2) boxes until none overlap, so no word is OCR'd twice."""
+    boxes = [list(b) for b in boxes]
+    merged = True
+    while merged:
+        merged = False
+        result = []
+        for box in boxes:
+            for other in result:
+                if box[0] < other[2] and other[0] < box[2] and box[1] < other[3] and other[1] < box[3]:
+                    other[0], other[1] = min(other[0], box[0]), min(other[1], box[1])
+                    other[2], other[3] = max(other[2], box[2]), max(other[3], box[3])
+                    merged = True
+                    break
+            else:
+                result.append(box)
+        boxes = result
+    return sorted((tuple(b) for b in boxes), key=lambda b: (b[1], b[0]))
+
+def detect_text_regions(image, pad=REGION_PAD, min_height=REGION_MIN_HEIGHT, max_coverage=REGION_MAX_COVERAGE):
+    """
+    Boxes (x1, y1, x2, y2) around the inked parts of a page: Otsu binarization, a dilation wide
+    enough to join the letters of a line and the lines of a block, then connected components.
+    Returns a single full-page box when the regions would cover most of the page anyway,
+    and no boxes for a blank page.
+    """
+    gray = to_gray(image)
+    h, w = gray.shape
+    # Block-level boxes do not need full resolution; the components pass is the costly step
+    scale = min(1.0, DETECT_MAX_SIZE / max(h, w))
+    small = cv2.resize(gray, (max(1, int(w * scale)), max(1, int(h * scale))), interpolation=cv2.INTER_AREA) if scale < 1 else gray
+    sh, sw = small.shape
+    _, binary = cv2.threshold(small, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    kx, ky = max(3, sw // 60), max(3, sh // 200)
+    dilated = cv2.dilate(binary, cv2.getStructuringElement(cv2.MORPH_RECT, (kx, ky)))
+    _, _, stats, _ = cv2.connectedComponentsWithStats(dilated, connectivity=8)
+
+    boxes = []
+    for x, y, bw, bh, _ in stats[1:]:
+        # Dilation grows every blob by the kernel, so judge the ink height it started from
+        if (bh - (ky - 1)) / scale < min_height:
+            continue
+        x1, y1, x2, y2 = int(x / scale), int(y / scale), int((x + bw) / scale) + 1, int((y + bh) / scale) + 1
+        boxes.append((max(0, x1 - pad), max(0, y1 - pad), min(w, x2 + pad), min(h, y2 + pad)))
+    boxes = merge_boxes(boxes)
+
+    covered = sum((x2 - x1) * (y2 - y1) for x1, y1, x2, y2 in boxes)
+    if covered > max_coverage * w * h:
+        return [(0, 0, w, h)]
+    return boxes